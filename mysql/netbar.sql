@@ -53,7 +53,18 @@ CREATE TABLE `binding_codes` (
   `code` varchar(10) NOT NULL,
   `card_uid` varchar(20) NOT NULL,
   `id_card` varchar(20) NOT NULL,
-  `created_at` datetime DEFAULT CURRENT_TIMESTAMP
+  `created_at` datetime DEFAULT CURRENT_TIMESTAMP,
+  KEY `idx_code` (`code`),
+  KEY `idx_card_uid` (`card_uid`),
+  KEY `idx_created_at` (`created_at`)
+) ENGINE = InnoDB DEFAULT CHARSET=utf8mb4;
+
+DROP TABLE IF EXISTS `billing_events`;
+CREATE TABLE `billing_events` (
+  `event_id` varchar(40) NOT NULL,
+  `event_type` varchar(32) NOT NULL,
+  `applied_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`event_id`)
 ) ENGINE = InnoDB DEFAULT CHARSET=utf8mb4;
 
 DROP TABLE IF EXISTS `alarm_log`;
@@ -65,7 +76,10 @@ CREATE TABLE `alarm_log`  (
   `message` varchar(255) NULL,
   `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `is_resolved` tinyint NULL DEFAULT 0,
-  PRIMARY KEY (`id`)
+  `occurrences` int NOT NULL DEFAULT 1,
+  `last_seen` datetime NULL,
+  PRIMARY KEY (`id`),
+  KEY `idx_dev_type_created` (`device_id`, `alarm_type`, `created_at`)
 ) ENGINE = InnoDB DEFAULT CHARSET=utf8mb4;
 
 DROP TABLE IF EXISTS `broadcast_log`;
@@ -134,6 +134,17 @@ float Read_Rate_From_EEPROM(void) {
     return price;
 }
 
+//  state ϱ (ep=)ݴ豸/ظı
+#define BOOT_EPOCH_ADDR 0x54
+static u32 g_boot_epoch = 0;
+void Boot_Epoch_Init(void) {
+    u8 *p = (u8*)&g_boot_epoch; u8 i;
+    for(i=0; i<4; i++) p[i] = AT24CXX_ReadOneByte(BOOT_EPOCH_ADDR + i);
+    if(g_boot_epoch == 0xFFFFFFFF) g_boot_epoch = 0; // EEPROM δд
+    g_boot_epoch++;
+    for(i=0; i<4; i++) { AT24CXX_WriteOneByte(BOOT_EPOCH_ADDR + i, p[i]); delay_ms(10); }
+}
+
 
 
 // =================  豸ϵ籣߼  =================
@@ -312,6 +323,7 @@ int main(void)
     if(AT24CXX_Check() == 0) {
         g_price_per_min = Read_Rate_From_EEPROM();
         Read_Name_From_EEPROM(g_seat_name); //  оƬȡһα
+        Boot_Epoch_Init();
     }
 
     TP_Init();            
@@ -729,13 +741,14 @@ static void App_HandleTouch(void) {
 }
 
 static void Netbar_Publish_SeatState(void) { 
-    char payload[96]; char topic[64]; 
+    char payload[128]; char topic[64]; 
     u8 human; u16 smoke_adc; u8 smoke_percent; u8 iu; u32 used_seconds; float fee; u8 alarm_active; 
     if (ESP8266_GetState() != WIFI_STATE_RUNNING) return; 
     human = Seat_Radar_Get(); smoke_adc = Seat_Smoke_GetRaw(); smoke_percent = Smoke_AdcToPercent(smoke_adc); 
     iu = (g_app.state == STATE_INUSE) ? 1 : 0; used_seconds = g_app.used_seconds; fee = (used_seconds / 60.0f) * g_price_per_min; alarm_active = g_idle_occupy_alarm || g_smoke_alarm; 
-    sprintf(payload, "s=1;iu=%d;pc=%d;lt=%d;hm=%d;sm=%d;sec=%lu;fee=%.2f;al=%d", iu, g_app.pc_on, g_app.light_on, human, smoke_percent, used_seconds, fee, alarm_active); 
-    publish_seq++; sprintf(topic, "netbar/%s/state", g_device_id); ESP8266_MQTT_Pub_Async(topic, payload); 
+    // ֻڱ WiFi ģʱȱڼ·
+    sprintf(payload, "s=1;iu=%d;pc=%d;lt=%d;hm=%d;sm=%d;sec=%lu;fee=%.2f;al=%d;q=%lu;ep=%lu", iu, g_app.pc_on, g_app.light_on, human, smoke_percent, used_seconds, fee, alarm_active, publish_seq + 1, g_boot_epoch); 
+    sprintf(topic, "netbar/%s/state", g_device_id); if (ESP8266_MQTT_Pub_Async(topic, payload)) publish_seq++; 
 }
 
 static void UID_HexStr_To_Bytes(const char *str, u8 *out_uid) {
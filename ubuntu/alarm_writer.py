@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+import metrics
+
+# ========= 告警合并写入 =========
+# 同一 (device_id, alarm_type) 在 WINDOW 秒内的重复告警合并成 alarm_log 的一行，
+# occurrences 记次数、last_seen 记最后一次时间，message 保留最新一条。
+# submit() 只改内存；后台线程每 FLUSH_SECS 把新行用一条多行 INSERT 写入、已有行逐行 UPDATE。
+# 待写入的告警种类数超过 max_entries 时丢弃新种类 (已有种类照常合并)，MySQL 变慢时不会拖垮进程。
+# 已处理 (is_resolved=1) 的行在窗口内再次出现会重新变成未处理。
+# 连接类错误 (transient_errors) 时保留待写次数下次重试；数据本身被拒绝的告警记日志后丢弃，不影响其他告警。
+
+# 与 alarm_log 的列宽一致
+DEVICE_ID_MAX = 32
+ALARM_TYPE_MAX = 32
+MESSAGE_MAX = 255
+
+INSERT_SQL = ("INSERT INTO alarm_log (device_id, alarm_type, message, occurrences, created_at, last_seen) "
+              "VALUES (%s, %s, %s, %s, %s, %s)")
+UPDATE_SQL = ("UPDATE alarm_log SET occurrences=occurrences+%s, last_seen=%s, message=%s, is_resolved=0 "
+              "WHERE device_id=%s AND alarm_type=%s AND created_at=%s")
+
+M_SUBMITTED = metrics.counter("netbar_alarms_submitted_total", "提交的告警数", ("type",))
+M_COLLAPSED = metrics.counter("netbar_alarms_collapsed_total", "合并进已有行的告警数")
+M_DROPPED   = metrics.counter("netbar_alarms_dropped_total", "缓冲区满丢弃的告警数")
+M_FAILED    = metrics.counter("netbar_alarms_failed_total", "被数据库拒绝而丢弃的告警行数", ("type",))
+M_FLUSH     = metrics.histogram("netbar_alarm_flush_seconds", "告警批量写入耗时")
+M_PENDING   = metrics.gauge("netbar_alarms_pending", "窗口内跟踪的告警行数")
+
+def _dt(ts: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(int(ts))
+
+class _Entry:
+    __slots__ = ("first_ts", "last_ts", "message", "pending", "inserted")
+
+    def __init__(self, now: float, message: str):
+        self.first_ts = int(now)   # 与 created_at 一致取整秒，UPDATE 时靠它定位行
+        self.last_ts = now
+        self.message = message
+        self.pending = 1
+        self.inserted = False
+
+def _insert_row(e: _Entry, n: int, k: Tuple[str, str]) -> tuple:
+    return (k[0], k[1], e.message, n, _dt(e.first_ts), _dt(e.last_ts))
+
+def _update_row(e: _Entry, n: int, k: Tuple[str, str]) -> tuple:
+    return (n, _dt(e.last_ts), e.message, k[0], k[1], _dt(e.first_ts))
+
+class AlarmWriter:
+    def __init__(self, connect: Callable[[], object], window: float = 300.0, flush_secs: float = 2.0, max_entries: int = 2000):
+        self.connect = connect
+        self.window = window
+        self.flush_secs = flush_secs
+        self.max_entries = max_entries
+        self.transient_errors: tuple = (OSError,)   # 连接类错误，遇到时重试而不是丢弃
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], _Entry] = {}
+
+    def submit(self, device_id: str, alarm_type: str, message: str):
+        now = time.time()
+        key = ((device_id or "")[:DEVICE_ID_MAX], (alarm_type or "")[:ALARM_TYPE_MAX])
+        message = (message or "")[:MESSAGE_MAX]
+        M_SUBMITTED.inc(key[1])
+        with self._lock:
+            e = self._entries.get(key)
+            # 窗口刚过但旧行还有没写出的次数时继续并入旧行，最多多并一个 flush 周期
+            if e is not None and (now - e.first_ts <= self.window or e.pending):
+                e.pending += 1
+                e.last_ts = now
+                e.message = message
+                M_COLLAPSED.inc()
+                return
+            if e is None and len(self._entries) >= self.max_entries:
+                M_DROPPED.inc()
+                return
+            self._entries[key] = _Entry(now, message)
+
+    def _write(self, sql: str, batch: List[tuple], make_row, multi_row: bool, handled: List[tuple]):
+        # 写成功或被拒绝丢弃的条目追加到 handled；连接类错误直接抛出，由调用方把其余条目放回
+        conn = self.connect()
+        try:
+            if multi_row:
+                # 参数全是占位符时 pymysql 把 executemany 拼成一条多行 INSERT，要么全部写入要么都不写
+                try:
+                    with conn.cursor() as cur: cur.executemany(sql, [make_row(*item) for item in batch])
+                    handled.extend(batch)
+                    return
+                except self.transient_errors: raise
+                except Exception as ex: logging.error("Alarm batch rejected, retrying row by row: %s", ex)
+            for item in batch:
+                try:
+                    with conn.cursor() as cur: cur.execute(sql, make_row(*item))
+                except self.transient_errors: raise
+                except Exception as ex: self._reject(item, ex)
+                handled.append(item)
+        finally: conn.close()
+
+    def _reject(self, item: tuple, error: Exception):
+        e, n, k = item
+        logging.error("Alarm %s/%s dropped (%d occurrences): %s", k[0], k[1], n, error)
+        M_FAILED.inc(k[1])
+        with self._lock:
+            if self._entries.get(k) is e: del self._entries[k]
+
+    def _take(self, inserted: bool) -> List[tuple]:
+        with self._lock:
+            batch = [(e, e.pending, k) for k, e in self._entries.items() if e.pending and e.inserted == inserted]
+            for e, _, _ in batch: e.pending = 0
+        return batch
+
+    def _give_back(self, batch: List[tuple]):
+        with self._lock:
+            for e, n, _ in batch: e.pending += n
+
+    def _flush_pass(self, inserted: bool) -> bool:
+        batch = self._take(inserted)
+        if not batch: return True
+        handled: List[tuple] = []
+        try:
+            if inserted: self._write(UPDATE_SQL, batch, _update_row, False, handled)
+            else: self._write(INSERT_SQL, batch, _insert_row, True, handled)
+            return True
+        except Exception as ex:
+            logging.error("Alarm %s error: %s", "update" if inserted else "insert", ex)
+            done = {id(item) for item in handled}
+            self._give_back([item for item in batch if id(item) not in done])
+            return False
+        finally:
+            # 新行写入后之后的次数走 UPDATE；被拒绝的条目已从 _entries 移除，标记与否不影响
+            for e, _, _ in handled: e.inserted = True
+
+    def flush(self):
+        with M_FLUSH.time():
+            if not self._flush_pass(inserted=False): return
+            if not self._flush_pass(inserted=True): return
+        now = time.time()
+        with self._lock:
+            for k in [k for k, e in self._entries.items() if not e.pending and now - e.first_ts > self.window]:
+                del self._entries[k]
+            M_PENDING.set(len(self._entries))
+
+    def start(self):
+        def loop():
+            while True:
+                time.sleep(self.flush_secs)
+                try: self.flush()
+                except Exception as e: logging.error("Alarm writer error: %s", e)
+        threading.Thread(target=loop, name="alarm-writer", daemon=True).start()
+
+def ensure_schema(conn):
+    # 老库补列，可重复执行
+    with conn.cursor() as cur:
+        cur.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='alarm_log'")
+        cols = {r["COLUMN_NAME"] for r in cur.fetchall()}
+        if "occurrences" not in cols: cur.execute("ALTER TABLE alarm_log ADD COLUMN occurrences int NOT NULL DEFAULT 1")
+        if "last_seen" not in cols: cur.execute("ALTER TABLE alarm_log ADD COLUMN last_seen datetime NULL")
+        cur.execute("SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='alarm_log' AND INDEX_NAME='idx_dev_type_created'")
+        if not cur.fetchone(): cur.execute("ALTER TABLE alarm_log ADD KEY idx_dev_type_created (device_id, alarm_type, created_at)")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import metrics
+
+try:
+    import numpy as np
+except ImportError:   # 没装 numpy 时 server_mqtt 不启用本模块，其余功能不受影响
+    np = None
+
+# ========= 烟雾 / 人体感应趋势检测 =========
+# 每个座位一行，所有滑动统计量都放在按座位下标的 NumPy 数组里：
+#   observe()  在 state 处理里只记下最新读数 (O(1))
+#   step()     每 tick 对全部座位做一次向量化更新并判定，开销与消息频率无关
+# 同一座位同一类告警只在进入异常时报一次，恢复后才会再次触发，且两次之间至少间隔 ALARM_MIN_INTERVAL。
+#
+# 告警类型:
+#   SMOKE_RISE    烟雾快 EWMA 明显高于慢 EWMA 且斜率持续为正 (还没到 SMOKE_ALARM_TH 的缓慢上升)
+#   SENSOR_FAULT  读数越界，或长时间卡在同一个高值 (正常环境下读数是低位小幅波动，可能长时间不变)
+#   IDLE_SEAT     计费中但人体感应长时间为无人
+
+ALPHA_FAST = 0.3     # 快 EWMA，约 3 个 tick
+ALPHA_SLOW = 0.02    # 慢 EWMA，约 50 个 tick，作为基线
+ALPHA_SLOPE = 0.1
+
+RISE_DELTA = 8.0        # 快慢 EWMA 差值 (百分点)
+RISE_SLOPE = 0.2        # 每秒上升的百分点
+RISE_TICKS = 10         # 连续满足多少个 tick 才报警
+STUCK_TICKS = 900       # 高位读数 15 分钟不变视为传感器卡死
+STUCK_LEVEL = 50.0
+IDLE_LEVEL = 0.05       # 人体感应 EWMA 低于该值视为无人
+IDLE_TICKS = 600        # 计费中连续无人 10 分钟
+ALARM_MIN_INTERVAL = 600.0
+MAX_ALARMS_PER_TICK = 20
+
+ALARM_TYPES = ("SMOKE_RISE", "SENSOR_FAULT", "IDLE_SEAT")
+
+M_TICK   = metrics.histogram("netbar_anomaly_tick_seconds", "异常检测每 tick 耗时")
+M_ALARMS = metrics.counter("netbar_anomaly_alarms_total", "异常检测产生的告警数", ("type",))
+M_SUPPRESSED = metrics.counter("netbar_anomaly_suppressed_total", "被限流的异常告警数", ("type",))
+
+class AnomalyDetector:
+    def __init__(self, capacity: int = 256, tick: float = 1.0):
+        if np is None: raise RuntimeError("numpy is required for AnomalyDetector")
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._idx: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._alloc(capacity)
+
+    def _alloc(self, capacity: int):
+        old = getattr(self, "_n", 0)
+        def grow(name, dtype, fill=0):
+            arr = np.full(capacity, fill, dtype=dtype)
+            if old: arr[:old] = getattr(self, name)[:old]
+            setattr(self, name, arr)
+        # 最新读数 (observe 写)
+        grow("_raw_smoke", np.float64); grow("_raw_human", np.float64)
+        grow("_in_use", np.bool_); grow("_fresh", np.bool_); grow("_seen", np.bool_)
+        # 滑动统计量 (step 写)
+        grow("_fast", np.float64); grow("_slow", np.float64); grow("_slope", np.float64)
+        grow("_prev", np.float64); grow("_human", np.float64, 1.0)
+        grow("_rise_run", np.int32); grow("_stuck_run", np.int32); grow("_idle_run", np.int32)
+        for t in ALARM_TYPES:
+            grow(f"_active_{t}", np.bool_)
+            grow(f"_last_{t}", np.float64, -np.inf)
+        self._n = capacity
+
+    def observe(self, device_id: str, smoke: float, human: int, in_use: bool):
+        with self._lock:
+            i = self._idx.get(device_id)
+            if i is None:
+                i = len(self._ids)
+                if i >= self._n: self._alloc(self._n * 2)
+                self._idx[device_id] = i
+                self._ids.append(device_id)
+            self._raw_smoke[i] = smoke
+            self._raw_human[i] = human
+            self._in_use[i] = in_use
+            self._fresh[i] = True
+
+    def forget(self, device_id: str):
+        # 下标保留给原设备，只清掉状态，设备回来时重新学习基线
+        with self._lock:
+            i = self._idx.get(device_id)
+            if i is None: return
+            self._seen[i] = False
+            self._fresh[i] = False
+            self._rise_run[i] = self._stuck_run[i] = self._idle_run[i] = 0
+
+    def step(self, now: Optional[float] = None) -> List[Tuple[str, str, str]]:
+        now = time.time() if now is None else now
+        # 整个 tick 持锁：几千个座位的向量化更新是微秒级，observe 最多等一个 tick
+        with self._lock, M_TICK.time():
+            n = len(self._ids)
+            if not n: return []
+            smoke = self._raw_smoke[:n].copy()
+            human = self._raw_human[:n].copy()
+            in_use = self._in_use[:n].copy()
+            fresh = self._fresh[:n].copy()
+            self._fresh[:n] = False
+            ids = self._ids
+
+            seen = self._seen[:n]
+            first = fresh & ~seen
+            # 首个读数直接作为基线
+            for name in ("_fast", "_slow", "_prev"): getattr(self, name)[:n][first] = smoke[first]
+            seen |= fresh
+            upd = fresh & ~first
+
+            fast, slow, slope, prev = self._fast[:n], self._slow[:n], self._slope[:n], self._prev[:n]
+            d = np.where(upd, smoke - prev, 0.0) / self.tick
+            fast += np.where(upd, ALPHA_FAST * (smoke - fast), 0.0)
+            slow += np.where(upd, ALPHA_SLOW * (smoke - slow), 0.0)
+            slope += np.where(upd, ALPHA_SLOPE * (d - slope), 0.0)
+            self._human[:n] += np.where(fresh, ALPHA_SLOW * (human - self._human[:n]), 0.0)
+
+            rising = upd & (fast - slow >= RISE_DELTA) & (slope >= RISE_SLOPE)
+            self._rise_run[:n] = np.where(rising, self._rise_run[:n] + 1, np.where(fresh, 0, self._rise_run[:n]))
+            same = upd & (smoke == prev) & (smoke >= STUCK_LEVEL)
+            self._stuck_run[:n] = np.where(same, self._stuck_run[:n] + 1, np.where(fresh, 0, self._stuck_run[:n]))
+            idle = fresh & in_use & (self._human[:n] < IDLE_LEVEL)
+            self._idle_run[:n] = np.where(idle, self._idle_run[:n] + 1, np.where(fresh, 0, self._idle_run[:n]))
+            prev[upd] = smoke[upd]
+
+            conditions = {
+                "SMOKE_RISE": self._rise_run[:n] >= RISE_TICKS,
+                "SENSOR_FAULT": seen & ((smoke < 0) | (smoke > 100) | (self._stuck_run[:n] >= STUCK_TICKS)),
+                "IDLE_SEAT": self._idle_run[:n] >= IDLE_TICKS,
+            }
+            alarms = []
+            for t, cond in conditions.items():
+                active = getattr(self, f"_active_{t}")[:n]
+                last = getattr(self, f"_last_{t}")[:n]
+                edge = cond & ~active
+                active[:] = cond
+                if not edge.any(): continue
+                allowed = edge & (now - last >= ALARM_MIN_INTERVAL)
+                suppressed = int(edge.sum() - allowed.sum())
+                for i in np.flatnonzero(allowed):
+                    if len(alarms) >= MAX_ALARMS_PER_TICK:
+                        active[i] = False   # 留到下个 tick 再报
+                        continue
+                    last[i] = now
+                    alarms.append((ids[i], t, self._describe(t, i, smoke[i])))
+                    M_ALARMS.inc(t)
+                if suppressed: M_SUPPRESSED.inc(t, amount=suppressed)
+        return alarms
+
+    def _describe(self, alarm_type: str, i: int, smoke: float) -> str:
+        if alarm_type == "SMOKE_RISE":
+            return f"烟雾浓度持续上升: 当前 {smoke:.0f}%，基线 {self._slow[i]:.0f}%，约 {self._slope[i] * 60:.0f}%/分"
+        if alarm_type == "SENSOR_FAULT":
+            if smoke < 0 or smoke > 100: return f"烟雾传感器读数越界: {smoke:.0f}"
+            return f"烟雾传感器读数长时间不变: {smoke:.0f}%"
+        return f"计费中但长时间检测不到人: 已持续约 {self._idle_run[i] * self.tick / 60:.0f} 分钟"
+
+    def start(self, emit: Callable[[str, str, str], None]):
+        def loop():
+            next_tick = time.monotonic()
+            while True:
+                next_tick += self.tick
+                time.sleep(max(0.0, next_tick - time.monotonic()))
+                try:
+                    for device_id, alarm_type, message in self.step(): emit(device_id, alarm_type, message)
+                except Exception as e: logging.error("Anomaly tick error: %s", e)
+        threading.Thread(target=loop, name="anomaly", daemon=True).start()
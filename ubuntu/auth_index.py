@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+from typing import Dict, List, Optional, Tuple
+import metrics
+
+# ========= 刷卡鉴权索引 =========
+# 启动时把所有已绑卡用户预计算成 {卡号: AuthEntry}，刷卡时只查内存；
+# 绑卡 / 编辑 / 充值 / 扣费后按用户增量更新。
+# 全量重建 (begin_rebuild + 查库 + build) 期间的增量更新会记下来，build 时在新数据上重放，
+# 查库之后才提交的扣费、充值不会被旧数据覆盖。
+
+M_LOOKUPS = metrics.counter("netbar_auth_index_lookups_total", "鉴权索引查询次数", ("result",))
+M_ENTRIES = metrics.gauge("netbar_auth_index_entries", "鉴权索引条目数")
+
+# (累计充值下限, 会员等级, 折扣)
+TIERS = ((1000, "钻石", 0.9), (500, "黄金", 0.93), (300, "白银", 0.95), (100, "青铜", 0.98))
+
+def tier_of(total_recharge: float) -> Tuple[str, float]:
+    for th, name, discount in TIERS:
+        if total_recharge >= th: return name, discount
+    return "普通", 1.0
+
+def normalize_uid(card_uid) -> str:
+    return (card_uid or "").strip().upper()
+
+def is_adult(identity_num: str, year: int) -> bool:
+    if not identity_num or len(identity_num) not in (15, 18): return False
+    try:
+        birth = identity_num[6:10] if len(identity_num) == 18 else "19" + identity_num[6:8]
+        return year - int(birth) >= 18
+    except ValueError: return False
+
+class AuthEntry:
+    __slots__ = ("user_id", "username", "id_card", "adult", "active", "balance", "total_recharge", "level_name", "discount")
+
+    def __init__(self, row: dict, year: int):
+        self.user_id = row["id"]
+        self.username = row["username"]
+        self.id_card = row["id_card"] or ""
+        self.adult = is_adult(self.id_card, year)
+        self.active = bool(row["is_active"])
+        self.balance = float(row["balance"])
+        self.total_recharge = float(row["total_recharge"])
+        self.level_name, self.discount = tier_of(self.total_recharge)
+
+class AuthIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_uid: Dict[str, AuthEntry] = {}
+        self._uid_of: Dict[int, str] = {}   # user_id -> 卡号，卡号变更时用来删旧键
+        self._year = datetime.date.today().year
+        self._replay: Optional[List[tuple]] = None   # 重建期间的增量更新
+
+    def __len__(self):
+        return len(self._by_uid)
+
+    def begin_rebuild(self):
+        # 在查库之前调用
+        with self._lock: self._replay = []
+
+    def build(self, rows):
+        by_uid, uid_of = {}, {}
+        year = datetime.date.today().year
+        for r in rows:
+            uid = normalize_uid(r["card_uid"])
+            if not uid: continue
+            by_uid[uid] = AuthEntry(r, year)
+            uid_of[r["id"]] = uid
+        with self._lock:
+            replay, self._replay = self._replay or [], None
+            self._by_uid, self._uid_of, self._year = by_uid, uid_of, year
+            for op, *args in replay: getattr(self, op)(*args)
+        M_ENTRIES.set(len(self._by_uid))
+
+    def upsert(self, row: dict):
+        with self._lock:
+            if self._replay is not None: self._replay.append(("_upsert", row))
+            self._upsert(row)
+        M_ENTRIES.set(len(self._by_uid))
+
+    def _upsert(self, row: dict):
+        uid = normalize_uid(row.get("card_uid"))
+        old = self._uid_of.pop(row["id"], None)
+        if old: self._by_uid.pop(old, None)
+        if uid:
+            self._by_uid[uid] = AuthEntry(row, self._year)
+            self._uid_of[row["id"]] = uid
+
+    def remove_user(self, user_id: int):
+        with self._lock:
+            if self._replay is not None: self._replay.append(("_remove_user", user_id))
+            self._remove_user(user_id)
+        M_ENTRIES.set(len(self._by_uid))
+
+    def _remove_user(self, user_id: int):
+        old = self._uid_of.pop(user_id, None)
+        if old: self._by_uid.pop(old, None)
+
+    def set_balance(self, user_id: int, balance: float):
+        with self._lock:
+            if self._replay is not None: self._replay.append(("_set_balance", user_id, balance))
+            self._set_balance(user_id, balance)
+
+    def _set_balance(self, user_id: int, balance: float):
+        entry = self._by_uid.get(self._uid_of.get(user_id, ""))
+        if entry is not None: entry.balance = balance
+
+    def export(self) -> List[dict]:
+        # 按 build() 接受的行格式导出，供本地快照使用
+        with self._lock: items = list(self._by_uid.items())
+        return [{"id": e.user_id, "username": e.username, "card_uid": uid, "id_card": e.id_card, "balance": e.balance,
+                 "total_recharge": e.total_recharge, "is_active": int(e.active)} for uid, e in items]
+
+    def get(self, card_uid: str) -> Optional[AuthEntry]:
+        year = datetime.date.today().year
+        if year != self._year:
+            # 跨年后成年判断可能变化，整体重算一次
+            with self._lock:
+                self._year = year
+                for e in self._by_uid.values(): e.adult = is_adult(e.id_card, year)
+        entry = self._by_uid.get(normalize_uid(card_uid))
+        M_LOOKUPS.inc("hit" if entry is not None else "miss")
+        return entry
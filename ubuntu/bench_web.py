@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+# ========= Web 后台吞吐量测试 =========
+# 模拟看板轮询 /api/seats_status，可同时加上持续登录的压力 (每次登录都要算一次口令哈希)。
+# 分别对开发服务器和 serve.py 跑一遍对比:
+#   python3 web_app.py                      ->  python3 bench_web.py --url http://127.0.0.1:5000 --user admin --password ...
+#   python3 serve.py --bind 127.0.0.1:5001  ->  python3 bench_web.py --url http://127.0.0.1:5001 --user admin --password ...
+#
+# 已测结果 (1 vCPU，Python 3.11，Flask 3.1，gunicorn 26；测试机没有 MySQL，只压了不查库的 /metrics，--clients 16 --duration 10):
+#   python3 web_app.py (开发服务器)          658 req/s  p50=23.0ms  p99=37.5ms
+#   python3 serve.py (gunicorn 2x8 gthread)  660 req/s  p50=21.3ms  p99=51.7ms
+# 单核上多进程没有收益，多核机器上需要重测；/login 和 /api/seats_status 依赖 MySQL，尚未测过。
+# 口令哈希对其他请求线程的影响用 python3 pwhash.py 单独测 (同一台机器，8 个线程持续验口令):
+#   直接在请求线程里算          轮询 p50=0.43ms  p99=36.6ms
+#   PasswordHasher(workers=1)   轮询 p50=0.51ms  p99=4.6ms   (登录吞吐 8.0/s -> 6.0/s)
+
+class _Client:
+    def __init__(self, host: str, port: int):
+        self.conn = http.client.HTTPConnection(host, port, timeout=30)
+        self.cookie = ""
+
+    def request(self, method: str, path: str, form=None) -> int:
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            self.conn.request(method, path, body, headers)
+            resp = self.conn.getresponse()
+            resp.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()   # 下次 request 自动重连
+            raise
+        cookie = resp.getheader("Set-Cookie")
+        if cookie: self.cookie = cookie.split(";", 1)[0]
+        return resp.status
+
+    def login(self, user: str, password: str) -> int:
+        return self.request("POST", "/login", {"username": user, "password": password})
+
+def _percentile(sorted_vals, p: float) -> float:
+    if not sorted_vals: return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * p))]
+
+def run(url: str, user: str, password: str, clients: int, logins: int, duration: float, path: str):
+    u = urlsplit(url)
+    host, port = u.hostname, u.port or 80
+    stop = threading.Event()
+    lock = threading.Lock()
+    poll_lat, login_lat = [], []
+    errors = [0]
+
+    def poller():
+        c = _Client(host, port)
+        c.login(user, password)
+        local = []
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try: ok = c.request("GET", path) == 200
+            except Exception: ok = False
+            if ok: local.append(time.perf_counter() - t0)
+            else:
+                with lock: errors[0] += 1
+        with lock: poll_lat.extend(local)
+
+    def login_loop():
+        c = _Client(host, port)
+        local = []
+        while not stop.is_set():
+            c.cookie = ""
+            t0 = time.perf_counter()
+            try: c.login(user, password)
+            except Exception: continue
+            local.append(time.perf_counter() - t0)
+        with lock: login_lat.extend(local)
+
+    threads = [threading.Thread(target=poller) for _ in range(clients)] + [threading.Thread(target=login_loop) for _ in range(logins)]
+    for t in threads: t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads: t.join()
+
+    poll_lat.sort(); login_lat.sort()
+    print(f"{url}  clients={clients} logins={logins} duration={duration:.0f}s")
+    print(f"  {path}: {len(poll_lat) / duration:,.0f} req/s  p50={_percentile(poll_lat, .5) * 1e3:.1f}ms  "
+          f"p99={_percentile(poll_lat, .99) * 1e3:.1f}ms  errors={errors[0]}")
+    if logins:
+        print(f"  /login: {len(login_lat) / duration:,.1f} req/s  p50={_percentile(login_lat, .5) * 1e3:.1f}ms  "
+              f"p99={_percentile(login_lat, .99) * 1e3:.1f}ms")
+
+def main():
+    ap = argparse.ArgumentParser(description="netbar web 后台吞吐量测试")
+    ap.add_argument("--url", default="http://127.0.0.1:5000")
+    ap.add_argument("--user", required=True, help="管理员账号")
+    ap.add_argument("--password", required=True)
+    ap.add_argument("--clients", type=int, default=32, help="并发轮询的看板数")
+    ap.add_argument("--logins", type=int, default=0, help="并发持续登录的线程数")
+    ap.add_argument("--duration", type=float, default=10.0)
+    ap.add_argument("--path", default="/api/seats_status")
+    args = ap.parse_args()
+    run(args.url, args.user, args.password, args.clients, args.logins, args.duration, args.path)
+
+if __name__ == "__main__":
+    main()
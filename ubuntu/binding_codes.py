@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import metrics
+
+# ========= 绑定码存储 =========
+# 未绑定卡刷卡时发放 6 位绑定码，有效期 1 天。内存里按绑定码 / 卡号建索引，
+# 保证有效期内的绑定码互不重复；过期条目由后台清理线程按到期时间堆淘汰，
+# 数据库里的过期行也由清理线程统一删除，刷卡路径上不再做全表清理。
+# 绑定码的核对在 web_app 的 portal_bind 里按 idx_code 查库，这里只负责发码去重和过期清理。
+
+CODE_TTL = 24 * 3600
+
+M_LIVE   = metrics.gauge("netbar_binding_codes_live", "当前有效的绑定码数")
+M_ISSUED = metrics.counter("netbar_binding_codes_issued_total", "发放的绑定码数")
+M_EXPIRED = metrics.counter("netbar_binding_codes_expired_total", "过期淘汰的绑定码数")
+
+class BindingCode:
+    __slots__ = ("code", "card_uid", "id_card", "expires")
+
+    def __init__(self, code: str, card_uid: str, id_card: str, expires: float):
+        self.code = code
+        self.card_uid = card_uid
+        self.id_card = id_card
+        self.expires = expires
+
+class BindingCodeStore:
+    def __init__(self, ttl: float = CODE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_code: Dict[str, BindingCode] = {}
+        self._by_card: Dict[str, str] = {}        # card_uid -> code
+        self._heap: List[Tuple[float, str]] = []  # (到期时刻, code)，作废的条目在出堆时跳过
+
+    def __len__(self):
+        return len(self._by_code)
+
+    def _drop(self, code: str) -> Optional[BindingCode]:
+        entry = self._by_code.pop(code, None)
+        if entry is not None and self._by_card.get(entry.card_uid) == code:
+            del self._by_card[entry.card_uid]
+        return entry
+
+    def _add(self, entry: BindingCode):
+        self._by_code[entry.code] = entry
+        self._by_card[entry.card_uid] = entry.code
+        heapq.heappush(self._heap, (entry.expires, entry.code))
+
+    def load(self, rows):
+        # rows: code, card_uid, id_card, created_ts (UNIX 时间戳)
+        now = time.time()
+        with self._lock:
+            for r in rows:
+                expires = float(r["created_ts"]) + self.ttl
+                if expires <= now or r["code"] in self._by_code: continue
+                old = self._by_card.get(r["card_uid"])
+                if old: self._drop(old)
+                self._add(BindingCode(r["code"], r["card_uid"], r["id_card"], expires))
+            M_LIVE.set(len(self._by_code))
+
+    def issue(self, card_uid: str, id_card: str) -> str:
+        # 同一张卡只保留最新的绑定码
+        with self._lock:
+            old = self._by_card.get(card_uid)
+            if old: self._drop(old)
+            while True:
+                code = str(random.randint(100000, 999999))
+                if code not in self._by_code: break
+            self._add(BindingCode(code, card_uid, id_card, time.time() + self.ttl))
+            M_LIVE.set(len(self._by_code))
+        M_ISSUED.inc()
+        return code
+
+    def discard(self, code: str):
+        with self._lock:
+            self._drop(code)
+            M_LIVE.set(len(self._by_code))
+
+    def expire(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        n = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires, code = heapq.heappop(self._heap)
+                entry = self._by_code.get(code)
+                if entry is not None and entry.expires == expires:
+                    self._drop(code)
+                    n += 1
+            # 作废条目太多时重建堆，防止反复刷同一张卡让堆无限增长
+            if len(self._heap) > 2 * len(self._by_code) + 64:
+                self._heap = [(e.expires, c) for c, e in self._by_code.items()]
+                heapq.heapify(self._heap)
+            M_LIVE.set(len(self._by_code))
+        if n: M_EXPIRED.inc(amount=n)
+        return n
+
+    def start_sweeper(self, interval: float = 60.0, purge_db: Optional[Callable[[], None]] = None):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire()
+                    if purge_db is not None: purge_db()
+                except Exception as e: logging.error("Binding code sweeper error: %s", e)
+        threading.Thread(target=loop, name="binding-code-sweeper", daemon=True).start()
+
+def ensure_schema(conn):
+    # 老库补索引，可重复执行
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='binding_codes'")
+        have = {r["INDEX_NAME"] for r in cur.fetchall()}
+        for name, col in (("idx_code", "code"), ("idx_card_uid", "card_uid"), ("idx_created_at", "created_at")):
+            if name not in have: cur.execute(f"ALTER TABLE binding_codes ADD KEY {name} ({col})")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List
+import metrics
+
+# ========= TTL + LRU 读穿缓存 =========
+# 写操作在本进程立即失效对应条目，并通过内部 MQTT 主题通知其他进程 (server_mqtt / 各 web worker)；
+# TTL 兜底 MQTT 通知丢失的情况。
+
+TOPIC_INVALIDATE = "netbar_internal/invalidate"
+
+M_REQUESTS  = metrics.counter("netbar_cache_requests_total", "缓存查询次数", ("cache", "result"))
+M_EVICTIONS = metrics.counter("netbar_cache_evictions_total", "缓存条目淘汰数", ("cache", "reason"))
+M_SIZE      = metrics.gauge("netbar_cache_entries", "缓存当前条目数", ("cache",))
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 30.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[object, tuple]" = OrderedDict()   # key -> (过期时刻, value)
+        self._gen = 0   # 每次失效 +1，防止失效前发起的慢查询把旧值写回
+
+    def get(self, key, loader: Callable[[], object]):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    M_REQUESTS.inc(self.name, "hit")
+                    return entry[1]
+                del self._data[key]
+                M_EVICTIONS.inc(self.name, "expired")
+            gen = self._gen
+        M_REQUESTS.inc(self.name, "miss")
+        value = loader()
+        with self._lock:
+            if gen == self._gen:
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    M_EVICTIONS.inc(self.name, "lru")
+            M_SIZE.set(len(self._data), self.name)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._gen += 1
+            if self._data.pop(key, None) is not None: M_EVICTIONS.inc(self.name, "invalidated")
+            M_SIZE.set(len(self._data), self.name)
+
+    def invalidate_where(self, pred: Callable[[object, object], bool]):
+        with self._lock:
+            self._gen += 1
+            for key in [k for k, (_, v) in self._data.items() if pred(k, v)]:
+                del self._data[key]
+                M_EVICTIONS.inc(self.name, "invalidated")
+            M_SIZE.set(len(self._data), self.name)
+
+    def clear(self):
+        with self._lock:
+            self._gen += 1
+            if self._data: M_EVICTIONS.inc(self.name, "invalidated", amount=len(self._data))
+            self._data.clear()
+            M_SIZE.set(0, self.name)
+
+# ========= 跨进程失效事件 =========
+# payload 为 JSON: {"entity": "users", "id": 3, "card_uid": "A1B2C3D4"} / {"entity": "config", "key": "price_per_min"}
+#                   {"entity": "devices", "device_id": "S01", "maint": 1} / {"entity": "sessions", "device_id": "S01"}
+# 发出的事件带 "origin": 发送进程的标识；进程自己的事件在 publish 时已经处理过，从 broker 收回来时跳过
+
+class InvalidationBus:
+    def __init__(self):
+        self._handlers: Dict[str, List[Callable[[dict], None]]] = {}
+        self.client = None
+        self._pid = None
+        self._origin = ""
+
+    def origin(self) -> str:
+        # fork 出来的 worker 要换一个，否则同一 master 下的 worker 会互相忽略对方的事件
+        pid = os.getpid()
+        if self._pid != pid: self._pid, self._origin = pid, uuid.uuid4().hex[:12]
+        return self._origin
+
+    def register(self, entity: str, handler: Callable[[dict], None]):
+        self._handlers.setdefault(entity, []).append(handler)
+
+    def apply(self, event: dict):
+        for h in self._handlers.get(event.get("entity"), ()):
+            try: h(event)
+            except Exception as e: logging.exception("Invalidation handler error: %s", e)
+
+    def publish(self, entity: str, **keys):
+        # 先失效本进程，再通知其他进程
+        event = {"entity": entity, **keys}
+        self.apply(event)
+        if self.client is None: return
+        try: self.client.publish(TOPIC_INVALIDATE, json.dumps({**event, "origin": self.origin()}), qos=1)
+        except Exception as e: logging.error("Invalidation publish error: %s", e)
+
+    def handle_message(self, topic: str, payload: bytes) -> bool:
+        if topic != TOPIC_INVALIDATE: return False
+        try: event = json.loads(payload.decode("utf-8"))
+        except ValueError: return True
+        if isinstance(event, dict) and event.get("origin") != self.origin(): self.apply(event)
+        return True
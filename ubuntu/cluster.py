@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+import metrics
+
+# ========= 多实例分片 =========
+# MODE_SINGLE  单实例，处理全部设备 (默认，与原行为一致)
+# MODE_HASH    每个实例都订阅 netbar/+/...，按 device_id 做 rendezvous hash，只处理归属自己的设备；
+#              成员通过 retained 心跳 + 遗嘱消息互相发现 (实例掉线时 broker 发出空的遗嘱清掉心跳)，
+#              成员变化时自动重新分配，只有归属变化的那部分设备会迁移；
+#              连上 broker 后先订阅成员主题并发出自己的心跳，收到自己的心跳 (retained 心跳都已送达) 之前
+#              不认领任何设备，避免新实例在看到其他成员之前把所有设备都当成自己的
+# MODE_SHARED  使用 MQTT 共享订阅 $share/<group>/...，由 broker 分发；
+#              必须把 broker 配成按主题哈希 (如 EMQX shared_subscription_strategy = hash_topic)，
+#              否则同一设备的消息可能落到不同实例
+
+MODE_SINGLE = "single"
+MODE_HASH   = "hash"
+MODE_SHARED = "shared"
+
+MEMBERS_PREFIX = "netbar_cluster/members/"
+
+M_MEMBERS    = metrics.gauge("netbar_cluster_members", "当前存活的 server_mqtt 实例数")
+M_REBALANCES = metrics.counter("netbar_cluster_rebalances_total", "成员变化引起的重新分片次数")
+M_FOREIGN    = metrics.counter("netbar_cluster_foreign_messages_total", "不归本实例处理而跳过的消息数")
+
+def _score(member: str, device_id: str) -> int:
+    return int.from_bytes(hashlib.md5(f"{member}|{device_id}".encode()).digest()[:8], "big")
+
+def owner_of(device_id: str, members) -> str:
+    return max(members, key=lambda m: _score(m, device_id))
+
+class Cluster:
+    def __init__(self, instance_id: str, mode: str = MODE_SINGLE, group: str = "netbar_core",
+                 heartbeat_secs: float = 5.0, member_ttl: float = 15.0):
+        self.instance_id = instance_id
+        self.mode = mode
+        self.group = group
+        self.heartbeat_secs = heartbeat_secs
+        self.member_ttl = member_ttl
+        self._lock = threading.Lock()
+        self._seen: Dict[str, float] = {instance_id: time.monotonic()}
+        self._members = (instance_id,)
+        self._owner_cache: Dict[str, str] = {}
+        self._client = None
+        self._synced = mode != MODE_HASH   # 是否已经拿到过一次完整的成员列表
+        self._started = time.monotonic()
+        self._sync_after = None            # 只认本次连接之后发出的自己的心跳，上次运行留下的 retained 心跳不算
+        self.rebalance_hooks: List[Callable[[tuple], None]] = []
+        M_MEMBERS.set(1)
+
+    @property
+    def members(self) -> tuple:
+        return self._members
+
+    @property
+    def member_topic(self) -> str:
+        return MEMBERS_PREFIX + self.instance_id
+
+    def topic_filter(self, topic: str) -> str:
+        return f"$share/{self.group}/{topic}" if self.mode == MODE_SHARED else topic
+
+    def configure_client(self, client):
+        self._client = client
+        if self.mode == MODE_HASH: client.will_set(self.member_topic, b"", qos=1, retain=True)
+
+    def on_connect(self, client):
+        if self.mode != MODE_HASH: return
+        self._sync_after = int(time.time())
+        client.subscribe(MEMBERS_PREFIX + "+", 1)
+        self._heartbeat()
+
+    def start(self):
+        self._started = time.monotonic()
+        if self.mode == MODE_HASH:
+            threading.Thread(target=self._heartbeat_loop, name="cluster-heartbeat", daemon=True).start()
+
+    def handle_message(self, topic: str, payload: bytes) -> bool:
+        if not topic.startswith(MEMBERS_PREFIX): return False
+        member = topic[len(MEMBERS_PREFIX):]
+        if member == self.instance_id:
+            try: fresh = bool(payload) and self._sync_after is not None and int(payload) >= self._sync_after
+            except ValueError: fresh = False
+            if fresh and not self._synced: self._first_sync()
+            return True
+        try: alive = bool(payload) and time.time() - int(payload) <= self.member_ttl
+        except ValueError: alive = False
+        with self._lock:
+            if alive: self._seen[member] = time.monotonic()
+            else: self._seen.pop(member, None)
+        self._recompute()
+        return True
+
+    @property
+    def synced(self) -> bool:
+        return self._synced
+
+    def owns(self, device_id: str) -> bool:
+        if self.mode != MODE_HASH: return True
+        if not self._synced: return False
+        if len(self._members) == 1: return True
+        owner = self._owner_cache.get(device_id)
+        if owner is None:
+            owner = self._owner_cache[device_id] = owner_of(device_id, self._members)
+        return owner == self.instance_id
+
+    def may_own(self, device_id: str) -> bool:
+        # 启动加载用: 成员列表同步之前先全部加载，同步后由 rebalance 钩子清掉不归自己的部分
+        return not self._synced or self.owns(device_id)
+
+    def count_foreign(self):
+        M_FOREIGN.inc()
+
+    def _first_sync(self):
+        with self._lock:
+            if self._synced: return
+            self._synced = True
+            self._owner_cache = {}
+            members = self._members
+        logging.info("Cluster membership synced: %s", ", ".join(members))
+        self._run_hooks(members)
+
+    def _heartbeat(self):
+        if self._client is not None:
+            self._client.publish(self.member_topic, str(int(time.time())).encode(), qos=1, retain=True)
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_secs)
+            try:
+                self._heartbeat()
+                now = time.monotonic()
+                with self._lock:
+                    self._seen[self.instance_id] = now
+                    for m in [m for m, t in self._seen.items() if now - t > self.member_ttl]:
+                        del self._seen[m]
+                self._recompute()
+            except Exception as e: logging.error("Cluster heartbeat error: %s", e)
+            # 一直没收到自己的心跳 (例如 broker 不回送) 时，最多等一个 member_ttl 就按当前成员开始工作
+            if not self._synced and time.monotonic() - self._started > self.member_ttl: self._first_sync()
+
+    def _recompute(self):
+        with self._lock:
+            members = tuple(sorted(self._seen))
+            if members == self._members: return
+            self._members = members
+            self._owner_cache = {}
+        M_MEMBERS.set(len(members))
+        M_REBALANCES.inc()
+        logging.info("Cluster members changed: %s", ", ".join(members))
+        if self._synced: self._run_hooks(members)
+
+    def _run_hooks(self, members: tuple):
+        for hook in self.rebalance_hooks:
+            try: hook(members)
+            except Exception as e: logging.exception("Rebalance hook error: %s", e)
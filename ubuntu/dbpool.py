@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from typing import Callable, List, Tuple
+import metrics
+
+# ========= MySQL 连接池 =========
+# 调用方式不变: conn = pool.connection(); try: ... finally: conn.close()
+# close() 把连接还回池里而不是断开；池满、连接已断开或出错时才真正关闭。
+#   - 池里没有空闲连接时直接新建，不排队等待 (并发上限由 WSGI 的 worker/线程数决定)
+#   - 空闲超过 PING_IDLE_SECS 的连接取出时先 ping，MySQL wait_timeout 断开的连接自动重连
+#   - fork 之后在子进程调用 reset()，丢弃从父进程继承的连接，各 worker 的连接互不共享
+
+PING_IDLE_SECS = 30.0
+
+M_IDLE    = metrics.gauge("netbar_db_pool_idle", "连接池中的空闲连接数")
+M_CHECKOUT = metrics.counter("netbar_db_pool_checkout_total", "从连接池取连接的次数", ("result",))
+
+class _PooledConnection:
+    __slots__ = ("_pool", "_conn")
+
+    def __init__(self, pool: "ConnectionPool", conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None: self._pool._release(conn)
+
+class ConnectionPool:
+    def __init__(self, connect: Callable[[], object], size: int = 8):
+        self.connect = connect
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[object, float]] = []
+        self._pid = os.getpid()
+
+    def connection(self) -> _PooledConnection:
+        conn = None
+        with self._lock:
+            if self._pid != os.getpid(): self._reset_locked()
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+                M_IDLE.set(len(self._idle))
+        if conn is not None and time.monotonic() - idle_since > PING_IDLE_SECS:
+            try: conn.ping(reconnect=True)
+            except Exception:
+                self._discard(conn)
+                conn = None
+        if conn is None:
+            conn = self.connect()
+            M_CHECKOUT.inc("new")
+        else: M_CHECKOUT.inc("reused")
+        return _PooledConnection(self, conn)
+
+    def _release(self, conn):
+        if getattr(conn, "open", False) and self._pid == os.getpid():
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((conn, time.monotonic()))
+                    M_IDLE.set(len(self._idle))
+                    return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        try: conn.close()
+        except Exception: pass
+
+    def _reset_locked(self):
+        # 继承来的 socket 仍被父进程使用，不能 close (会发 COM_QUIT 断掉父进程的连接)，只丢掉引用
+        self._idle = []
+        self._pid = os.getpid()
+        M_IDLE.set(0)
+
+    def reset(self):
+        with self._lock: self._reset_locked()
+
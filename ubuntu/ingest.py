@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+import metrics
+
+# ========= 带优先级的有界入站队列 =========
+# paho 回调线程只负责入队，业务处理在独立 worker 线程里按优先级出队：
+#   CRITICAL  刷卡 / 门禁 / 设备 checkout / 告警，永不丢弃
+#   NORMAL    debug 等其他消息
+#   STATE     周期状态，每台设备只保留最新一条，过载或过期时优先丢弃
+
+PRIO_CRITICAL = 0
+PRIO_NORMAL   = 1
+PRIO_STATE    = 2
+
+POLICY_DROP_STATE = "drop_state"   # 满了丢最旧的 state，保证计费消息不被拖慢
+POLICY_BLOCK      = "block"        # 满了阻塞回调线程，把压力交给 broker
+
+M_DEPTH     = metrics.gauge("netbar_ingest_queue_depth", "入站队列当前长度", ("prio",))
+M_DROPPED   = metrics.counter("netbar_ingest_dropped_total", "被丢弃的入站消息数", ("reason",))
+M_COLLAPSED = metrics.counter("netbar_ingest_collapsed_total", "被同设备更新 state 覆盖的消息数")
+M_WAIT      = metrics.histogram("netbar_ingest_wait_seconds", "消息在入站队列中的等待时间", ("prio",))
+
+_PRIO_NAMES = ("critical", "normal", "state")
+
+class IngestQueue:
+    def __init__(self, capacity: int = 5000, policy: str = POLICY_DROP_STATE, state_max_age: float = 5.0):
+        self.capacity = capacity
+        self.policy = policy
+        self.state_max_age = state_max_age
+        self._cond = threading.Condition()
+        self._critical = deque()
+        self._normal = deque()
+        self._state: "OrderedDict[str, tuple]" = OrderedDict()   # device_id -> (入队时刻, item)
+
+    def __len__(self):
+        return len(self._critical) + len(self._normal) + len(self._state)
+
+    def _drop_oldest_state(self) -> bool:
+        if not self._state: return False
+        self._state.popitem(last=False)
+        M_DROPPED.inc("overflow")
+        return True
+
+    def put(self, prio: int, device_id: str, item) -> bool:
+        now = time.monotonic()
+        with self._cond:
+            if prio == PRIO_STATE and device_id in self._state:
+                # 保留原排队位置，只替换为最新内容，避免高频设备插队也避免饿死
+                self._state[device_id] = (now, item)
+                M_COLLAPSED.inc()
+                return True
+            if len(self) >= self.capacity:
+                if self.policy == POLICY_BLOCK:
+                    while len(self) >= self.capacity: self._cond.wait()
+                elif not self._drop_oldest_state() and prio == PRIO_STATE:
+                    M_DROPPED.inc("overflow")
+                    return False
+            if prio == PRIO_STATE: self._state[device_id] = (now, item)
+            elif prio == PRIO_CRITICAL: self._critical.append((now, item))
+            else: self._normal.append((now, item))
+            self._cond.notify_all()
+        return True
+
+    def get(self, timeout: Optional[float] = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while not len(self):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0: return None
+                    self._cond.wait(remaining)
+                now = time.monotonic()
+                if self._critical: prio, (t, item) = PRIO_CRITICAL, self._critical.popleft()
+                elif self._normal: prio, (t, item) = PRIO_NORMAL, self._normal.popleft()
+                else:
+                    prio, (_, (t, item)) = PRIO_STATE, self._state.popitem(last=False)
+                    if now - t > self.state_max_age:
+                        M_DROPPED.inc("stale")
+                        self._cond.notify_all()
+                        continue
+                self._cond.notify_all()
+                M_WAIT.observe(now - t, _PRIO_NAMES[prio])
+                return item
+
+    def update_depth_metrics(self):
+        M_DEPTH.set(len(self._critical), "critical")
+        M_DEPTH.set(len(self._normal), "normal")
+        M_DEPTH.set(len(self._state), "state")
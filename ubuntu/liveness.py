@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+import metrics
+
+# ========= 设备在线检测 (时间轮) =========
+# 每台设备在时间轮上挂一个超时槽位，收到消息时把它挪到 now + timeout 对应的槽 (O(1))；
+# 时间轮每 tick 只处理当前槽里的设备，这些设备都已超时，所以每 tick 的开销只和掉线数量有关，
+# 与设备总数无关。启动时用 arm() 登记上次运行时还在线的设备，其余设备在第一次收到消息后开始跟踪。
+
+M_ONLINE      = metrics.gauge("netbar_devices_online", "在线设备数")
+M_TRANSITIONS = metrics.counter("netbar_device_transitions_total", "设备上下线次数", ("to",))
+
+class LivenessTracker:
+    def __init__(self, timeout: float = 8.0, tick: float = 1.0):
+        self.timeout = timeout
+        self.tick = tick
+        self._span = int(math.ceil(timeout / tick)) + 1   # 多留一格，保证不会早于 timeout 判定离线
+        self._wheel: List[Set[str]] = [set() for _ in range(self._span + 1)]
+        self._slot_of: Dict[str, int] = {}   # 在线设备 -> 所在槽位
+        self._last_seen: Dict[str, float] = {}
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._suspended = False
+        self.on_online: Optional[Callable[[str, float], None]] = None    # (device_id, 离线时长秒，首次上线为 0)
+        self.on_offline: Optional[Callable[[str, float], None]] = None   # (device_id, 最后一次收到消息的时间戳)
+
+    def _arm(self, device_id: str):
+        old = self._slot_of.get(device_id)
+        if old is not None: self._wheel[old].discard(device_id)
+        slot = (self._cursor + self._span) % len(self._wheel)
+        self._wheel[slot].add(device_id)
+        self._slot_of[device_id] = slot
+
+    def touch(self, device_id: str):
+        now = time.time()
+        with self._lock:
+            was_online = device_id in self._slot_of
+            prev = self._last_seen.get(device_id)
+            self._last_seen[device_id] = now
+            self._arm(device_id)
+            if not was_online: M_ONLINE.set(len(self._slot_of))
+        if not was_online:
+            M_TRANSITIONS.inc("online")
+            if self.on_online is not None: self.on_online(device_id, now - prev if prev else 0.0)
+
+    def arm(self, device_id: str, last_seen: float):
+        # 按在线处理但不触发 on_online，从现在起 timeout 内仍没有消息就照常判定离线
+        with self._lock:
+            if device_id in self._slot_of: return
+            self._last_seen.setdefault(device_id, last_seen)
+            self._arm(device_id)
+            M_ONLINE.set(len(self._slot_of))
+
+    def is_online(self, device_id: str) -> bool:
+        return device_id in self._slot_of
+
+    def devices(self) -> List[str]:
+        return list(self._last_seen)
+
+    def forget(self, device_id: str):
+        # 设备转给其他实例后不再跟踪，避免误报离线
+        with self._lock:
+            slot = self._slot_of.pop(device_id, None)
+            if slot is not None: self._wheel[slot].discard(device_id)
+            self._last_seen.pop(device_id, None)
+            M_ONLINE.set(len(self._slot_of))
+
+    def suspend(self):
+        # 本进程与 broker 断开时收不到任何消息，此时不能判定设备离线
+        with self._lock: self._suspended = True
+
+    def resume(self):
+        # 重连后给所有在线设备重新计时
+        with self._lock:
+            self._suspended = False
+            for did in list(self._slot_of): self._arm(did)
+
+    def advance(self) -> List[str]:
+        with self._lock:
+            if self._suspended: return []
+            self._cursor = (self._cursor + 1) % len(self._wheel)
+            expired = self._wheel[self._cursor]
+            if not expired: return []
+            self._wheel[self._cursor] = set()
+            for did in expired: del self._slot_of[did]
+            M_ONLINE.set(len(self._slot_of))
+            last_seen = {did: self._last_seen.get(did, 0.0) for did in expired}
+        M_TRANSITIONS.inc("offline", amount=len(last_seen))
+        if self.on_offline is not None:
+            for did, ts in last_seen.items():
+                try: self.on_offline(did, ts)
+                except Exception as e: logging.exception("Offline handler error: %s", e)
+        return list(last_seen)
+
+    def start(self):
+        def loop():
+            next_tick = time.monotonic()
+            while True:
+                next_tick += self.tick
+                time.sleep(max(0.0, next_tick - time.monotonic()))
+                try: self.advance()
+                except Exception as e: logging.error("Liveness tick error: %s", e)
+        threading.Thread(target=loop, name="liveness", daemon=True).start()
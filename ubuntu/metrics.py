@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+import pymysql
+
+# ========= Prometheus 文本格式的轻量指标 =========
+# Counter / Gauge / Histogram + 一个本地 /metrics HTTP 端点，server_mqtt 和 web_app 共用
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: Dict[str, "_Metric"] = {}
+_registry_lock = threading.Lock()
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(names, values, extra="") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, label_values) -> Tuple:
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"{self.name}: expected labels {self.labels}, got {label_values}")
+        return tuple(str(v) for v in label_values)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self._lock: items = list(self._values.items())
+        for key, value in sorted(items):
+            yield f"{self.name}{_fmt_labels(self.labels, key)} {value}"
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1.0):
+        key = self._key(label_values)
+        with self._lock: self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(self._key(label_values), 0.0)
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        key = self._key(label_values)
+        with self._lock: self._values[key] = value
+
+    def inc(self, *label_values, amount: float = 1.0):
+        key = self._key(label_values)
+        with self._lock: self._values[key] = self._values.get(key, 0.0) + amount
+
+    def remove(self, *label_values):
+        with self._lock: self._values.pop(self._key(label_values), None)
+
+    def value(self, *label_values) -> float:
+        return self._values.get(self._key(label_values), 0.0)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            st = self._values.get(key)
+            if st is None:
+                st = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    st[0][i] += 1
+                    break
+            st[1] += value
+            st[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - t0, *label_values)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock: items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        for key, (counts, total, n) in sorted(items):
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c
+                le = 'le="%s"' % b
+                yield f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {acc}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {n}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, key)} {n}"
+
+def _register(cls, name, help_text, labels, **kw):
+    with _registry_lock:
+        m = _registry.get(name)
+        if m is None:
+            m = _registry[name] = cls(name, help_text, labels, **kw)
+            if not m.labels and cls is not Histogram: m._values[()] = 0.0   # 无标签指标从 0 开始导出
+        elif not isinstance(m, cls):
+            raise ValueError(f"metric {name} already registered as {m.kind}")
+        return m
+
+def counter(name: str, help_text: str, labels=()) -> Counter:
+    return _register(Counter, name, help_text, labels)
+
+def gauge(name: str, help_text: str, labels=()) -> Gauge:
+    return _register(Gauge, name, help_text, labels)
+
+def histogram(name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help_text, labels, buckets=buckets)
+
+def render() -> str:
+    with _registry_lock: ms = list(_registry.values())
+    lines = []
+    for m in ms: lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+# ========= 多进程汇总 =========
+# gunicorn 多 worker 时每个进程各有一份计数，单个进程的 render() 只是恰好处理请求的那个 worker 的数字。
+# 各 worker 用 start_dump() 定期把自己的数值写到共享目录下的 <pid>.json，render_dir() 读全部文件合并:
+# counter / histogram 按标签相加，gauge 是进程内的瞬时值，加 pid 标签分别导出。
+# 已退出的 worker 的文件直接删掉，它的计数随之消失，Prometheus 按计数器重置处理。
+
+def dump() -> dict:
+    with _registry_lock: ms = list(_registry.values())
+    out = {}
+    for m in ms:
+        with m._lock: values = [[list(k), [list(v[0]), v[1], v[2]] if isinstance(v, list) else v] for k, v in m._values.items()]
+        out[m.name] = {"kind": m.kind, "help": m.help, "labels": list(m.labels), "buckets": list(getattr(m, "buckets", ())), "values": values}
+    return out
+
+def write_dump(directory: str):
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f: json.dump(dump(), f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+def start_dump(directory: str, interval: float = 5.0):
+    def loop():
+        while True:
+            try: write_dump(directory)
+            except OSError: pass
+            time.sleep(interval)
+    threading.Thread(target=loop, name="metrics-dump", daemon=True).start()
+
+def _alive(pid: int) -> bool:
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
+def render_dir(directory: str) -> str:
+    dumps = {os.getpid(): dump()}   # 本进程用最新的数值
+    for fn in os.listdir(directory):
+        stem = fn[:-len(".json")]
+        if not fn.endswith(".json") or not stem.isdigit() or int(stem) in dumps: continue
+        path = os.path.join(directory, fn)
+        if not _alive(int(stem)):
+            try: os.remove(path)
+            except OSError: pass
+            continue
+        try:
+            with open(path, encoding="utf-8") as f: dumps[int(stem)] = json.load(f)
+        except (OSError, ValueError): continue
+    merged: Dict[str, _Metric] = {}
+    for pid, d in sorted(dumps.items()):
+        for name, m in d.items():
+            kind, labels = m["kind"], tuple(m["labels"])
+            t = merged.get(name)
+            if t is None:
+                if kind == "gauge": t = Gauge(name, m["help"], labels + ("pid",))
+                elif kind == "histogram": t = Histogram(name, m["help"], labels, m["buckets"])
+                else: t = Counter(name, m["help"], labels)
+                merged[name] = t
+            if t.kind != kind: continue
+            for k, v in m["values"]:
+                key = tuple(k)
+                if kind == "gauge": t._values[key + (str(pid),)] = v
+                elif kind == "histogram":
+                    st = t._values.get(key)
+                    if st is None: t._values[key] = [list(v[0]), v[1], v[2]]
+                    else:
+                        st[0] = [a + b for a, b in zip(st[0], v[0])]
+                        st[1] += v[1]
+                        st[2] += v[2]
+                else: t._values[key] = t._values.get(key, 0.0) + v
+    lines = []
+    for m in merged.values(): lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args): pass
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+# ========= 数据库耗时 =========
+DB_CONNECTIONS = counter("netbar_db_connections_total", "打开的数据库连接数")
+DB_QUERY_SECONDS = histogram("netbar_db_query_seconds", "按语句统计的 SQL 执行耗时", ("stmt",))
+
+_STMT_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+`?(\w+)", re.I)
+_stmt_cache: Dict[str, str] = {}
+
+def stmt_label(sql: str) -> str:
+    # 语句都是源码里的常量字符串，缓存后每次只是一次字典查找
+    label = _stmt_cache.get(sql)
+    if label is None:
+        verb = sql.split(None, 1)[0].lower() if sql.strip() else "empty"
+        m = _STMT_TABLE_RE.search(sql)
+        label = f"{verb}_{m.group(1).lower()}" if m else verb
+        if len(_stmt_cache) < 1024: _stmt_cache[sql] = label
+    return label
+
+class TimedDictCursor(pymysql.cursors.DictCursor):
+    def execute(self, query, args=None):
+        t0 = time.perf_counter()
+        try: return super().execute(query, args)
+        finally: DB_QUERY_SECONDS.observe(time.perf_counter() - t0, stmt_label(query))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from itertools import islice
+from typing import Callable, Dict, List, Optional
+import metrics
+
+# ========= 计费事件本地日志 (outbox) =========
+# 计费相关事件 (开台、结账扣费、强制下机) 先追加到本地 JSONL 文件并 fsync，再由后台线程按顺序写入 MySQL：
+#   - append() 返回时事件已落盘；多个线程同时追加时共用一次 fsync (group commit)
+#   - 每个事件带全局唯一 eid，写库时与 billing_events 表的插入放在同一个事务里，重放时已写过的事件直接跳过
+#   - 数据库不可用时停在当前事件上退避重试，顺序不乱；进程重启后从文件恢复未写完的事件
+#   - 所有事件都写入后截断文件
+# 数据本身有问题的事件 (非连接类错误) 写到 <path>.failed 并跳过，避免卡住后续事件。
+# billing_events 表由写库线程在第一次写库前建好，建表失败 (例如启动时 MySQL 不可用) 就一直重试，不会把事件当坏数据丢掉。
+
+M_PENDING = metrics.gauge("netbar_outbox_pending", "尚未写入 MySQL 的计费事件数")
+M_APPEND  = metrics.histogram("netbar_outbox_append_seconds", "计费事件追加落盘耗时 (含 fsync)")
+M_APPLIED = metrics.counter("netbar_outbox_applied_total", "写入 MySQL 的计费事件数", ("type", "result"))
+M_RETRIES = metrics.counter("netbar_outbox_retries_total", "写库失败后的重试次数")
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS billing_events (
+  event_id varchar(40) NOT NULL,
+  event_type varchar(32) NOT NULL,
+  applied_at datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (event_id)
+) ENGINE = InnoDB DEFAULT CHARSET=utf8mb4"""
+
+class Outbox:
+    def __init__(self, path: str, connect: Callable[[], object], batch: int = 100, retry_secs: float = 2.0):
+        self.path = path
+        self.connect = connect
+        self.batch = batch
+        self.retry_secs = retry_secs
+        self.appliers: Dict[str, Callable[[object, dict], Optional[dict]]] = {}   # type -> fn(cursor, event) -> 结果
+        self.on_applied: Optional[Callable[[dict, Optional[dict]], None]] = None
+        self.transient_errors: tuple = (OSError,)   # 连接类错误，遇到时重试而不是跳过
+        self._lock = threading.Lock()         # 保护文件追加和 _queue
+        self._sync_lock = threading.Lock()
+        self.drain_lock = threading.Lock()   # 写库 + 出队期间持有；持有它时库里的数据加上 pending() 不会漏事件
+        self._cond = threading.Condition(self._lock)
+        self._queue: "deque[dict]" = deque()
+        self._written = 0   # 已 write 的事件序号
+        self._synced = 0    # 已 fsync 的事件序号
+        self._f = None
+        self._schema_ok = False
+
+    def recover(self) -> List[dict]:
+        events = []
+        if os.path.exists(self.path):
+            good = 0   # 最后一个完整行结束处的字节偏移
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"): break   # 崩溃时写了一半的最后一行
+                    good += len(line)
+                    try: events.append(json.loads(line.decode("utf-8")))
+                    except ValueError: logging.error("Outbox: bad line skipped: %r", line[:200])
+            # 截掉半行，否则下一次追加会接在半行后面，整行在下次恢复时被当成坏行丢掉
+            if os.path.getsize(self.path) > good:
+                logging.warning("Outbox: truncating partial line at offset %d", good)
+                with open(self.path, "r+b") as f:
+                    f.truncate(good)
+                    os.fsync(f.fileno())
+        self._f = open(self.path, "a", encoding="utf-8")
+        with self._lock:
+            self._queue.extend(events)
+            M_PENDING.set(len(self._queue))
+        if events: logging.info("Outbox: %d events recovered from %s", len(events), self.path)
+        return events
+
+    def pending(self) -> List[dict]:
+        with self._lock: return list(self._queue)
+
+    def append(self, event_type: str, **fields) -> dict:
+        event = {"eid": uuid.uuid4().hex, "type": event_type, "ts": time.time(), **fields}
+        line = json.dumps(event, ensure_ascii=False) + "\n"
+        t0 = time.perf_counter()
+        # 写文件和入队在同一把锁里，保证截断文件时不会丢掉刚写入、还没入队的事件；
+        # 写库可能先于 fsync 发生，这不影响持久性 (已经在库里了)
+        with self._lock:
+            self._f.write(line)
+            self._written += 1
+            seq = self._written
+            self._queue.append(event)
+            M_PENDING.set(len(self._queue))
+        self._sync(seq)
+        with self._lock: self._cond.notify()
+        M_APPEND.observe(time.perf_counter() - t0)
+        return event
+
+    def _sync(self, seq: int):
+        # 拿到锁的线程一次 fsync 掉此前所有线程写入的内容，排队的线程发现已经覆盖到自己就直接返回
+        with self._sync_lock:
+            if self._synced >= seq: return
+            with self._lock:
+                self._f.flush()
+                upto = self._written
+            os.fsync(self._f.fileno())
+            self._synced = upto
+
+    def _apply_one(self, conn, event: dict) -> bool:
+        applier = self.appliers.get(event["type"])
+        if applier is None:
+            logging.error("Outbox: no applier for %s", event["type"])
+            return False
+        conn.begin()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("INSERT IGNORE INTO billing_events (event_id, event_type) VALUES (%s, %s)", (event["eid"], event["type"]))
+                if cur.rowcount == 0:
+                    conn.rollback()
+                    M_APPLIED.inc(event["type"], "duplicate")
+                    return True
+                result = applier(cur, event)
+            conn.commit()
+        except Exception:
+            try: conn.rollback()
+            except Exception: pass
+            raise
+        M_APPLIED.inc(event["type"], "ok")
+        if self.on_applied is not None:
+            try: self.on_applied(event, result)
+            except Exception as e: logging.exception("Outbox on_applied error: %s", e)
+        return True
+
+    def _dead_letter(self, event: dict, error: Exception):
+        logging.error("Outbox: event %s failed, moved to %s.failed: %s", event.get("eid"), self.path, error)
+        M_APPLIED.inc(event.get("type", "?"), "failed")
+        with open(self.path + ".failed", "a", encoding="utf-8") as f:
+            f.write(json.dumps({**event, "error": str(error)}, ensure_ascii=False) + "\n")
+
+    def drain_once(self) -> int:
+        with self.drain_lock: return self._drain_locked()
+
+    def _drain_locked(self) -> int:
+        with self._lock: batch = list(islice(self._queue, self.batch))
+        if not batch: return 0
+        done = 0
+        conn = self.connect()
+        try:
+            if not self._schema_ok:
+                ensure_schema(conn)
+                self._schema_ok = True
+            for event in batch:
+                try:
+                    if not self._apply_one(conn, event): self._dead_letter(event, RuntimeError("no applier"))
+                except self.transient_errors: raise
+                except Exception as e: self._dead_letter(event, e)
+                done += 1
+        finally:
+            with self._lock:
+                for _ in range(done): self._queue.popleft()
+                M_PENDING.set(len(self._queue))
+                self._truncate_if_drained()
+            try: conn.close()
+            except Exception: pass
+        return done
+
+    def _truncate_if_drained(self):
+        # 调用方持有 _lock；全部写完且没有新追加时清空文件
+        if self._queue or self._f is None or self._f.tell() == 0: return
+        self._f.flush()
+        self._f.truncate(0)
+        self._f.seek(0)
+
+    def start(self):
+        def loop():
+            while True:
+                with self._lock:
+                    while not self._queue: self._cond.wait()
+                try: self.drain_once()
+                except Exception as e:
+                    logging.error("Outbox drain error, retrying in %.0fs: %s", self.retry_secs, e)
+                    M_RETRIES.inc()
+                    time.sleep(self.retry_secs)
+        threading.Thread(target=loop, name="outbox-drainer", daemon=True).start()
+
+def ensure_schema(conn):
+    with conn.cursor() as cur: cur.execute(SCHEMA)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Optional
+
+# ========= 运行时可开关的采样分析器 =========
+# 后台线程定时抓取 sys._current_frames()，不挂 settrace，开启期间对 1Hz 上报几乎无影响。
+# 结束后写出 flamegraph.pl / speedscope 可直接读取的 collapsed stack 文件，
+# 以及按 handler 统计的 CPU 时间。
+
+MAX_SECONDS = 300
+
+_code_names: Dict[object, str] = {}
+
+def _frame_name(code) -> str:
+    name = _code_names.get(code)
+    if name is None:
+        mod = os.path.splitext(os.path.basename(code.co_filename))[0]
+        name = _code_names[code] = f"{mod}:{code.co_name}"
+    return name
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005, out_dir: str = "."):
+        self.interval = interval
+        self.out_dir = out_dir
+        self.active = False
+        self._lock = threading.Lock()
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        self._handler_cpu: Dict[str, list] = defaultdict(lambda: [0, 0.0])   # kind -> [次数, CPU 秒]
+
+    def start(self, seconds: float) -> bool:
+        seconds = max(1.0, min(float(seconds), MAX_SECONDS))
+        with self._lock:
+            if self.active: return False
+            self.active = True
+            self._stacks = Counter()
+            self._samples = 0
+            self._handler_cpu.clear()
+        threading.Thread(target=self._run, args=(seconds,), name="sampling-profiler", daemon=True).start()
+        logging.info("Profiler started for %.0fs (interval %.1f ms)", seconds, self.interval * 1000)
+        return True
+
+    def record_handler(self, kind: str, cpu_secs: float):
+        # 采样结束时 _run 会在锁内换掉 _handler_cpu，这里也要持锁
+        with self._lock:
+            st = self._handler_cpu[kind]
+            st[0] += 1
+            st[1] += cpu_secs
+
+    def _run(self, seconds: float):
+        me = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        t_start = time.time()
+        try:
+            while time.monotonic() < deadline:
+                for tid, frame in sys._current_frames().items():
+                    if tid == me: continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_name(frame.f_code))
+                        frame = frame.f_back
+                    tname = names.get(tid)
+                    if tname is None:
+                        names = {t.ident: t.name for t in threading.enumerate()}
+                        tname = names.get(tid, str(tid))
+                    stack.append(tname)
+                    stack.reverse()
+                    self._stacks[";".join(stack)] += 1
+                self._samples += 1
+                time.sleep(self.interval)
+        finally:
+            # 先在锁内换出结果再写文件，写完才允许下一次 start()，正在结束的 handler 也只会记到新的空表里
+            with self._lock:
+                stacks, self._stacks = self._stacks, Counter()
+                handler_cpu, self._handler_cpu = self._handler_cpu, defaultdict(lambda: [0, 0.0])
+                samples = self._samples
+            try: self._dump(t_start, stacks, handler_cpu, samples)
+            finally: self.active = False
+
+    def _dump(self, t_start: float, stacks: Counter, handler_cpu: Dict[str, list], samples: int) -> Optional[str]:
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(t_start))
+        base = os.path.join(self.out_dir, f"profile-{stamp}")
+        try:
+            with open(base + ".collapsed", "w", encoding="utf-8") as f:
+                for stack, n in stacks.most_common(): f.write(f"{stack} {n}\n")
+            with open(base + ".handlers.txt", "w", encoding="utf-8") as f:
+                f.write(f"samples={samples} interval_ms={self.interval * 1000:.1f}\n")
+                f.write("kind          count    cpu_ms   avg_cpu_ms\n")
+                for kind, (n, cpu) in sorted(handler_cpu.items(), key=lambda kv: -kv[1][1]):
+                    f.write(f"{kind:<12} {n:6d} {cpu * 1000:9.1f} {cpu * 1000 / n:10.3f}\n")
+            logging.info("Profiler finished: %s.collapsed (%d samples)", base, samples)
+            return base
+        except Exception as e:
+            logging.error("Profiler dump error: %s", e)
+            return None
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import partial
+from werkzeug.security import check_password_hash, generate_password_hash
+import metrics
+
+# ========= 口令哈希计算 =========
+# check_password_hash / generate_password_hash 每次要几十到几百毫秒 CPU。
+# 放到一个小的专用线程池里算 (hashlib 计算时释放 GIL)，同一 worker 里同时在算的哈希不超过 workers 个，
+# 其余请求线程 (看板轮询等) 不会被一波登录占满；排队的也不超过 max_pending 个，超出直接返回 Busy，
+# 由路由提示稍后再试，而不是让请求线程一直堆着等。等待超过 timeout 同样返回 Busy；
+# 名额在哈希真正算完 (或还没开始就被取消) 时才归还，超时放弃等待的请求不会让排队上限失效。
+
+M_HASH_SECONDS = metrics.histogram("netbar_password_hash_seconds", "口令哈希计算耗时 (含排队)", ("op",))
+M_HASH_REJECTED = metrics.counter("netbar_password_hash_rejected_total", "哈希队列已满被拒绝的请求数", ("op",))
+M_HASH_TIMEOUTS = metrics.counter("netbar_password_hash_timeouts_total", "等待哈希超时的请求数", ("op",))
+
+class Busy(Exception):
+    pass
+
+class PasswordHasher:
+    def __init__(self, workers: int = 0, max_pending: int = 32, timeout: float = 10.0):
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.workers + max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pwhash")
+
+    def _run(self, op: str, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            M_HASH_REJECTED.inc(op)
+            raise Busy(op)
+        try: fut = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        fut.add_done_callback(partial(self._done, op, time.perf_counter()))
+        try: return fut.result(self.timeout)
+        except FutureTimeout:
+            fut.cancel()   # 还在排队的直接取消；已经在算的算完后由 _done 归还名额
+            M_HASH_TIMEOUTS.inc(op)
+            raise Busy(op)
+
+    def _done(self, op: str, t0: float, fut):
+        self._slots.release()
+        if not fut.cancelled(): M_HASH_SECONDS.observe(time.perf_counter() - t0, op)
+
+    def check(self, pwhash: str, password: str) -> bool:
+        return self._run("check", check_password_hash, pwhash, password)
+
+    def generate(self, password: str) -> str:
+        return self._run("generate", generate_password_hash, password)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+# ========= 并发测试 =========
+# python3 pwhash.py [秒数]   8 个线程持续登录 (验口令) 的同时，另一个线程反复做一小段纯 Python 计算 (代表看板轮询)，
+# 对比直接在请求线程里算哈希和经过 PasswordHasher 两种方式下轮询的延迟
+
+def _bench(duration: float):
+    hashed = generate_password_hash("secret")
+    t0 = time.perf_counter()
+    check_password_hash(hashed, "secret")
+    print(f"one check_password_hash: {(time.perf_counter() - t0) * 1e3:.0f} ms  (cpus={os.cpu_count()}, python {sys.version.split()[0]})")
+
+    def run(label: str, check):
+        stop = threading.Event()
+        lat, done = [], [0]
+        def login():
+            while not stop.is_set():
+                try:
+                    check(hashed, "secret")
+                    done[0] += 1
+                except Busy: time.sleep(0.01)
+        def poll():
+            while not stop.is_set():
+                t = time.perf_counter()
+                sum(range(20000))
+                lat.append(time.perf_counter() - t)
+        threads = [threading.Thread(target=login) for _ in range(8)] + [threading.Thread(target=poll)]
+        for t in threads: t.start()
+        time.sleep(duration)
+        stop.set()
+        for t in threads: t.join()
+        lat.sort()
+        print(f"  {label}: logins {done[0] / duration:.1f}/s   polls {len(lat) / duration:.0f}/s   "
+              f"poll p50={lat[len(lat) // 2] * 1e3:.2f}ms p99={lat[int(len(lat) * 0.99)] * 1e3:.2f}ms")
+
+    run("inline          ", check_password_hash)
+    hasher = PasswordHasher(1, 32)
+    run("PasswordHasher(1)", hasher.check)
+    hasher.shutdown()
+
+if __name__ == "__main__":
+    _bench(float(sys.argv[1]) if len(sys.argv) > 1 else 10.0)
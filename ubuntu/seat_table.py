@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, Optional
+
+# ========= 共享内存座位表 =========
+# server_mqtt 写、web_app 读的定长 mmap 文件 (默认放在 /dev/shm，不落盘)。
+# 每个座位一条定长记录，记录头是 seqlock 序号：写者先把序号改成奇数，写完字段再改成下一个偶数；
+# 读者读到奇数或前后序号不一致就重读。两个进程都可以单独重启，文件内容一直保留。
+# 同一进程里多个线程写 (ingest_worker、启动校正线程) 由 _lock 串行；flock 只在进程之间互斥，
+# 同进程的线程共用一个 fd，互相不排斥。
+#
+# 文件头: magic, version, record_size, capacity, count
+# 记录:   seq | device_id | seat_name | status maint pc light human pad | smoke | sec | fee | last_update | user_id | user_name
+
+MAGIC   = b"NBST"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sHHII")
+_COUNT  = struct.Struct("<I")
+COUNT_OFFSET = 12
+HEADER_SIZE = 64
+_SEQ  = struct.Struct("<I")
+_BODY = struct.Struct("<32s32s6BHIddi32s")
+RECORD_SIZE = _SEQ.size + _BODY.size
+
+FIELDS = ("device_id", "seat_name", "status", "maint", "pc", "light", "human", "_pad",
+          "smoke", "sec", "fee", "last_update", "user_id", "user_name")
+_IDX = {name: i for i, name in enumerate(FIELDS)}
+_TEXT_FIELDS = ("device_id", "seat_name", "user_name")
+
+def _enc(s) -> bytes:
+    return (s or "").encode("utf-8")[:32]
+
+def _dec(b: bytes) -> str:
+    return b.rstrip(b"\0").decode("utf-8", errors="ignore")
+
+def _slot_offset(slot: int) -> int:
+    return HEADER_SIZE + slot * RECORD_SIZE
+
+class SeatTableWriter:
+    def __init__(self, path: str, capacity: int = 4096):
+        self.path = path
+        self.capacity = capacity
+        self._open()
+        self._slots: Dict[str, int] = {}
+        self._rows: Dict[str, list] = {}   # 本进程写过的记录副本，局部更新时合并用
+        self._scanned = 0
+        self._lock = threading.Lock()
+        self._scan()
+
+    def _open(self):
+        size = HEADER_SIZE + self.capacity * RECORD_SIZE
+        valid = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            with open(self.path, "rb") as f:
+                magic, ver, rsize, cap, _ = _HEADER.unpack(f.read(_HEADER.size))
+            valid = (magic, ver, rsize, cap) == (MAGIC, VERSION, RECORD_SIZE, self.capacity)
+        if not valid:
+            # 布局不兼容时整体替换文件；读者发现 inode 变化后会自动重新映射
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.truncate(size)
+                f.write(_HEADER.pack(MAGIC, VERSION, RECORD_SIZE, self.capacity, 0))
+            os.replace(tmp, self.path)
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._mm = mmap.mmap(self._fd, size)
+
+    def _count(self) -> int:
+        return _HEADER.unpack_from(self._mm, 0)[4]
+
+    def _scan(self):
+        # 其他实例 (多实例部署) 可能新分配了槽位，补扫新增部分
+        count = self._count()
+        for slot in range(self._scanned, count):
+            did = _dec(_BODY.unpack_from(self._mm, _slot_offset(slot) + _SEQ.size)[0])
+            if did: self._slots[did] = slot
+        self._scanned = count
+
+    def _slot(self, device_id: str) -> Optional[int]:
+        # 调用方持有 _lock
+        slot = self._slots.get(device_id)
+        if slot is not None: return slot
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._scan()
+            slot = self._slots.get(device_id)
+            if slot is None:
+                count = self._count()
+                if count >= self.capacity: return None
+                slot = count
+                off = _slot_offset(slot)
+                seq = _SEQ.unpack_from(self._mm, off)[0]
+                _SEQ.pack_into(self._mm, off, seq + 1)
+                _BODY.pack_into(self._mm, off + _SEQ.size, _enc(device_id), _enc(device_id), 0, 0, 0, 0, 0, 0, 0, 0, 0.0, 0.0, 0, b"")
+                _SEQ.pack_into(self._mm, off, seq + 2)
+                _COUNT.pack_into(self._mm, COUNT_OFFSET, count + 1)
+                self._slots[device_id] = slot
+                self._scanned = count + 1
+            return slot
+        finally: fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def drop_local_copies(self):
+        # 多实例重新分片后丢弃本地副本，下次写入时从共享内存重新读取，避免覆盖其他实例写入的字段
+        with self._lock: self._rows.clear()
+
+    def get(self, device_id: str) -> Optional[dict]:
+        # 本进程看到的当前记录，设备还没有槽位时返回 None
+        with self._lock:
+            row = self._rows.get(device_id)
+            if row is None:
+                slot = self._slots.get(device_id)
+                if slot is None: return None
+                row = _BODY.unpack_from(self._mm, _slot_offset(slot) + _SEQ.size)
+        rec = dict(zip(FIELDS, row))
+        for k in _TEXT_FIELDS: rec[k] = _dec(rec[k])
+        del rec["_pad"]
+        return rec
+
+    def update(self, device_id: str, **fields):
+        with self._lock:
+            slot = self._slot(device_id)
+            if slot is None: return
+            off = _slot_offset(slot)
+            row = self._rows.get(device_id)
+            if row is None:
+                row = self._rows[device_id] = list(_BODY.unpack_from(self._mm, off + _SEQ.size))
+            for k, v in fields.items():
+                row[_IDX[k]] = _enc(v) if k in _TEXT_FIELDS else v
+            seq = _SEQ.unpack_from(self._mm, off)[0] | 1
+            _SEQ.pack_into(self._mm, off, seq)
+            _BODY.pack_into(self._mm, off + _SEQ.size, *row)
+            _SEQ.pack_into(self._mm, off, seq + 1)
+
+class SeatTableReader:
+    def __init__(self, path: str):
+        self.path = path
+        self._mm = None
+        self._ino = None
+
+    def _ensure(self) -> bool:
+        try: st = os.stat(self.path)
+        except FileNotFoundError:
+            self._mm = None
+            return False
+        if self._mm is not None and st.st_ino == self._ino: return True
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, ver, rsize, _, _ = _HEADER.unpack_from(mm, 0)
+        if (magic, ver, rsize) != (MAGIC, VERSION, RECORD_SIZE):
+            mm.close()
+            self._mm = None
+            return False
+        self._mm, self._ino = mm, st.st_ino
+        return True
+
+    def _read_slot(self, slot: int, retries: int = 100) -> Optional[tuple]:
+        off = _slot_offset(slot)
+        mm = self._mm
+        for _ in range(retries):
+            s1 = _SEQ.unpack_from(mm, off)[0]
+            if s1 & 1:
+                time.sleep(0)
+                continue
+            vals = _BODY.unpack_from(mm, off + _SEQ.size)
+            if _SEQ.unpack_from(mm, off)[0] == s1: return vals
+        return None
+
+    def read_all(self) -> Optional[Dict[str, dict]]:
+        if not self._ensure(): return None
+        count = _HEADER.unpack_from(self._mm, 0)[4]
+        out = {}
+        for slot in range(count):
+            vals = self._read_slot(slot)
+            if vals is None: continue
+            rec = dict(zip(FIELDS, vals))
+            for k in _TEXT_FIELDS: rec[k] = _dec(rec[k])
+            del rec["_pad"]
+            if rec["device_id"]: out[rec["device_id"]] = rec
+        return out
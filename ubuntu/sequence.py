@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from typing import Dict, Optional
+import metrics
+
+# ========= state 报文序号检查 =========
+# 固件在 state 里带 q=<发送序号>、ep=<启动次数>。QoS 0 下报文可能重复或乱序，
+# 在入队前按 (epoch, seq) 丢掉重复和过期的 state，避免旧状态覆盖新状态；序号缺口记为链路丢包。
+#   - epoch 变化: 设备重启，从新序号重新开始
+#   - 带了真实 epoch (ep>0) 的设备，同一 epoch 内的回退一律是过期报文，丢弃
+#   - 没有 epoch 或 ep 恒为 0 (没有 EEPROM 的板子) 时只能靠序号猜重启:
+#     回退超过 REORDER_WINDOW 视为重启；窗口内的回退当作乱序丢弃，但连续 STALE_RESET 条窗口内的新序号
+#     (重启前序号本来就很小) 也按重启处理。窗口内已经收到过的序号算重复，不计入连续次数
+#   - 没有序号的老固件报文一律放行
+
+REORDER_WINDOW = 32   # QoS 0 下实际乱序不会超过几十条
+STALE_RESET = 3
+_SEEN_MASK = (1 << REORDER_WINDOW) - 1
+_WRAP = 1 << 32
+_HALF = 1 << 31
+
+M_SKIPPED = metrics.counter("netbar_state_skipped_total", "按序号丢弃的 state 报文数", ("reason",))
+M_LOST    = metrics.counter("netbar_state_seq_lost_total", "按序号缺口推算的丢失 state 报文数", ("device",))
+M_QUALITY = metrics.gauge("netbar_device_link_quality", "state 报文到达率 (EWMA，1 为不丢包)", ("device",))
+M_RESETS  = metrics.counter("netbar_state_seq_resets_total", "设备重启导致的序号重置次数")
+
+QUALITY_ALPHA = 0.05
+
+class _Track:
+    __slots__ = ("epoch", "seq", "quality", "stale", "seen")
+
+    def __init__(self, epoch, seq: int):
+        self.epoch = epoch
+        self.seq = seq
+        self.quality = 1.0
+        self.stale = 0   # 连续按乱序丢弃的条数
+        self.seen = 1    # 第 i 位表示 seq - i 已收到
+
+class SequenceTracker:
+    # 只在 MQTT 回调线程里调用，不加锁
+    def __init__(self):
+        self._tracks: Dict[str, _Track] = {}
+
+    def accept(self, device_id: str, seq: Optional[int], epoch: Optional[int]) -> bool:
+        if seq is None: return True
+        t = self._tracks.get(device_id)
+        if t is None or (epoch is not None and epoch != t.epoch):
+            if t is not None: M_RESETS.inc()
+            self._tracks[device_id] = _Track(epoch, seq)
+            return True
+        d = (seq - t.seq) % _WRAP
+        if d == 0:
+            M_SKIPPED.inc("duplicate")
+            return False
+        if d >= _HALF:
+            back = _WRAP - d
+            if back < REORDER_WINDOW and t.seen >> back & 1:
+                M_SKIPPED.inc("duplicate")
+                return False
+            if not epoch:
+                t.stale += 1
+                if back > REORDER_WINDOW or t.stale >= STALE_RESET:
+                    M_RESETS.inc()
+                    self._tracks[device_id] = _Track(epoch, seq)
+                    return True
+            if back < REORDER_WINDOW: t.seen |= 1 << back
+            M_SKIPPED.inc("stale")
+            return False
+        t.stale = 0
+        t.seen = ((t.seen << d) | 1) & _SEEN_MASK if d < REORDER_WINDOW else 1
+        lost = d - 1
+        if lost:
+            M_LOST.inc(device_id, amount=lost)
+            t.quality *= (1.0 - QUALITY_ALPHA) ** lost   # 每个缺口按一次 0 计入
+        t.quality += QUALITY_ALPHA * (1.0 - t.quality)
+        M_QUALITY.set(round(t.quality, 4), device_id)
+        t.seq = seq
+        return True
+
+    def devices(self):
+        return list(self._tracks)
+
+    def forget(self, device_id: str):
+        if self._tracks.pop(device_id, None) is not None: M_QUALITY.remove(device_id)
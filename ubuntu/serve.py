@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import web_app
+
+# ========= Web 后台生产环境启动 =========
+# python3 serve.py [--workers N] [--threads N] [--bind 0.0.0.0:5000]
+# 优先用 gunicorn (多进程，每个进程多线程 gthread)，没装时退回 waitress (单进程多线程)。
+# 开发调试仍然可以直接 python3 web_app.py。
+#
+# 多进程时每个 worker 各自有连接池、缓存和指标计数；缓存失效通过 netbar_internal/invalidate 广播到所有 worker，
+# 指标由各 worker 定期写到一个临时目录，/metrics 读出来合并 (见 metrics.render_dir)。
+
+DEFAULT_BIND = "0.0.0.0:5000"
+DEFAULT_THREADS = 8
+
+def default_workers() -> int:
+    return max(2, (os.cpu_count() or 1) + 1)
+
+def run_gunicorn(bind: str, workers: int, threads: int) -> bool:
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        return False
+
+    # fork 之前设置，所有 worker 共用；每次启动一个新目录，不会混进上次运行的 worker
+    tmp_dir = None
+    if not web_app.METRICS_DIR: web_app.METRICS_DIR = tmp_dir = tempfile.mkdtemp(prefix="netbar_web_metrics_")
+
+    class _App(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", bind)
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", True)    # master 只导入一次，worker fork 后再各自初始化
+            self.cfg.set("timeout", 30)
+            self.cfg.set("keepalive", 5)
+            self.cfg.set("post_fork", lambda server, worker: web_app.init_worker())
+            if tmp_dir: self.cfg.set("on_exit", lambda server: shutil.rmtree(tmp_dir, ignore_errors=True))
+
+        def load(self):
+            return web_app.app
+
+    _App().run()
+    return True
+
+def run_waitress(bind: str, threads: int) -> bool:
+    try:
+        from waitress import serve
+    except ImportError:
+        return False
+    web_app.init_worker()
+    serve(web_app.app, listen=bind, threads=threads)
+    return True
+
+def main():
+    ap = argparse.ArgumentParser(description="netbar web 后台生产环境启动")
+    ap.add_argument("--bind", default=DEFAULT_BIND)
+    ap.add_argument("--workers", type=int, default=default_workers())
+    ap.add_argument("--threads", type=int, default=DEFAULT_THREADS)
+    ap.add_argument("--server", choices=("auto", "gunicorn", "waitress"), default="auto")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.server in ("auto", "gunicorn") and run_gunicorn(args.bind, args.workers, args.threads): return
+    if args.server in ("auto", "waitress") and run_waitress(args.bind, args.threads): return
+    raise SystemExit("gunicorn / waitress 未安装: pip3 install gunicorn (或 waitress)")
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,33 @@
 
 import logging
 import datetime
+import os
+import re
+import socket
 import time
-import random
+import signal
 import threading
+import zlib
 from typing import Dict, Optional
 import paho.mqtt.client as mqtt
 import pymysql
+import metrics
+import tracing
+import profiler
+import ingest
+import cluster
+import seat_table
+import state_writer
+import cache
+import auth_index
+import binding_codes
+import liveness
+import anomaly
+import alarm_writer
+import outbox
+import state_codec
+import sequence
+import snapshot
 
 # ========= 基本配置 =========
 MQTT_BROKER    = "127.0.0.1"
@@ -23,6 +44,41 @@ TOPIC_CARD  = "netbar/+/card"
 TOPIC_DOOR  = "netbar/+/door_card"
 TOPIC_ALERT = "netbar/+/alert"
 TOPIC_CMD   = "netbar/+/cmd" 
+TOPIC_ADMIN_PROFILE = "netbar_admin/profile"   # payload 为采样秒数，也可 kill -USR1 <pid>
+
+# 多实例部署: NETBAR_CLUSTER_MODE=hash NETBAR_INSTANCE_ID=core1 python3 server_mqtt.py
+# 多实例时 NETBAR_INSTANCE_ID 必须给出且重启后保持不变: outbox / 快照文件名和 /metrics 端口都由它决定
+CLUSTER_MODE  = os.environ.get("NETBAR_CLUSTER_MODE", cluster.MODE_SINGLE)
+INSTANCE_ID   = os.environ.get("NETBAR_INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+CLUSTER_GROUP = "netbar_core"
+_FILE_SUFFIX  = "" if CLUSTER_MODE == cluster.MODE_SINGLE else "." + re.sub(r"[^\w.-]", "_", INSTANCE_ID)
+
+# 与 web_app 共享的座位表 (多实例部署时各实例需在同一台主机上)
+SEAT_TABLE_PATH     = "/dev/shm/netbar_seats"
+SEAT_TABLE_CAPACITY = 4096
+
+CONFIG_CACHE_TTL = 60.0
+
+BINDING_SWEEP_SECS = 60.0   # 过期绑定码清理间隔
+
+OFFLINE_SECS = 8.0                # 超过这么久没收到设备消息判定离线，与 web_app 一致
+PRESENCE_ARM_SECS = 600.0         # 启动时 last_update 在这么久以内的设备视为上次运行时在线，照常检测离线
+OFFLINE_BILLING_POLICY = "none"   # none: 只告警；settle: 离线时按当前时刻结算未结束的会话
+
+ANOMALY_ENABLED = True   # 烟雾 / 人体感应趋势检测，需要 numpy
+
+DEVICE_FLUSH_SECS = 1.0     # devices 表 (设备状态) 后台批量写库间隔
+
+ALARM_WINDOW_SECS = 300.0   # 同设备同类告警在该窗口内合并为一行
+ALARM_FLUSH_SECS  = 2.0
+ALARM_MAX_ENTRIES = 2000    # 待写入告警行上限，超出后丢弃新种类
+
+OUTBOX_PATH = f"billing_outbox{_FILE_SUFFIX}.jsonl"   # 计费事件本地日志，MySQL 不可用时在这里排队
+
+SNAPSHOT_PATH        = f"netbar_snapshot{_FILE_SUFFIX}.bin"   # 内存状态本地快照，启动时先从这里恢复
+SNAPSHOT_SECS        = 15.0
+SNAPSHOT_MAX_AGE     = 86400.0                 # 超过这么久的快照不用，直接从 MySQL 加载
+RECONCILE_RETRY_SECS = 5.0
 
 DB_HOST = "127.0.0.1"
 DB_PORT = 3306
@@ -33,17 +89,142 @@ DB_NAME = "netbar"
 MIN_BALANCE    = 1.0
 SMOKE_ALARM_TH = 60
 
+# 本地 /metrics 端口，0 表示不开启；多实例时默认按实例 ID 错开，也可用 NETBAR_METRICS_PORT 指定
+METRICS_PORT = int(os.environ.get("NETBAR_METRICS_PORT") or
+                   (9108 if CLUSTER_MODE == cluster.MODE_SINGLE else 9109 + zlib.crc32(INSTANCE_ID.encode()) % 90))
+
+SLOW_TRACE_MS = 300                  # 刷卡链路超过该耗时即写入慢 trace 文件
+TRACE_FILE    = "slow_traces.jsonl"  # 用 python3 tracing.py 查看
+TRACED_KINDS  = ("card", "door_card", "cmd")
+
+PROFILE_SECS     = 30      # SIGUSR1 触发时的默认采样时长
+PROFILE_INTERVAL = 0.005   # 采样间隔 (秒)
+PROFILE_DIR      = "."
+
+INGEST_CAPACITY      = 5000                      # 入站队列容量 (state 按设备合并后计)
+INGEST_POLICY        = ingest.POLICY_DROP_STATE  # 过载策略: drop_state / block
+INGEST_STATE_MAX_AGE = 5.0                       # 排队超过该秒数的 state 视为过期直接丢弃
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
-mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=True)
+mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID if CLUSTER_MODE == cluster.MODE_SINGLE else f"{MQTT_CLIENT_ID}_{INSTANCE_ID}", clean_session=True)
+shard = cluster.Cluster(INSTANCE_ID, CLUSTER_MODE, CLUSTER_GROUP)
+
+# ========= 运行指标 =========
+M_MESSAGES      = metrics.counter("netbar_mqtt_messages_total", "按主题类型统计的入站消息数", ("kind",))
+M_HANDLER       = metrics.histogram("netbar_handler_seconds", "按主题类型统计的消息处理耗时", ("kind",))
+M_PUBLISH       = metrics.counter("netbar_mqtt_publish_total", "下发的 MQTT 消息数", ("subtopic",))
+M_BALANCE_EMPTY = metrics.counter("netbar_balance_empty_checkout_total", "余额耗尽强制下机次数")
+M_SWIPE         = metrics.histogram("netbar_swipe_response_seconds", "刷卡消息到首条应答下发的耗时", ("kind",))
+M_READY         = metrics.gauge("netbar_startup_ready_seconds", "启动到内存状态可用的耗时", ("source",))
+M_RECONCILE     = metrics.gauge("netbar_snapshot_reconcile_seconds", "从快照启动后与 MySQL 校正完成的耗时")
+
+_swipe_started: Dict[str, tuple] = {}   # device_id -> (kind, 收到刷卡消息的时刻)，只在 ingest_worker 处理该刷卡期间存在
+
+sampler = profiler.SamplingProfiler(PROFILE_INTERVAL, PROFILE_DIR)
+seats: Optional[seat_table.SeatTableWriter] = None
+detector = None   # anomaly.AnomalyDetector，main() 里按 numpy 是否可用创建
+
+inbox = ingest.IngestQueue(INGEST_CAPACITY, INGEST_POLICY, INGEST_STATE_MAX_AGE)
+
+# ========= 内存状态 (刷卡决策路径只读这些，不查库) =========
+auth = auth_index.AuthIndex()            # 卡号 -> 鉴权信息
+open_sessions: Dict[str, Dict] = {}      # device_id -> 未结束的 user_session_log 行
+_sessions_lock = threading.Lock()        # 开台 / 结账的 outbox 追加与 open_sessions 更新放在一起，全量重载时不会夹在中间
+device_maint: Dict[str, int] = {}        # device_id -> is_maintenance
+codes = binding_codes.BindingCodeStore()
+presence = liveness.LivenessTracker(OFFLINE_SECS)
+seqs = sequence.SequenceTracker()
+
+# ========= 缓存 (web_app 的写操作通过 netbar_internal/invalidate 通知失效) =========
+config_cache = cache.TTLCache("config", 16, CONFIG_CACHE_TTL)
+bus = cache.InvalidationBus()
+bus.client = mqtt_client
+
+def on_users_changed(event: dict):
+    # 在后台线程回查该用户，不阻塞 MQTT 回调
+    threading.Thread(target=refresh_auth_user, args=(event.get("id"), event.get("card_uid")), daemon=True).start()
+
+def on_sessions_changed(event: dict):
+    # 不带 applied 的是 web 端强制下机；带 applied 的是其他实例的 outbox 刚写进库的开台 / 结账，
+    # 设备在那之前已经转给本实例时靠它补上 (或结掉) 会话
+    did = event.get("device_id")
+    if not did: return
+    applied = event.get("applied")
+    if applied is None:
+        with _sessions_lock: open_sessions.pop(did, None)
+        return
+    if event.get("instance") == INSTANCE_ID or not shard.owns(did): return
+    with _sessions_lock:
+        current = open_sessions.get(did)
+        if applied == "start" and current is None:
+            open_sessions[did] = {"id": event["id"], "eid": event.get("eid"), "user_name": event["user_name"], "device_id": did, "card_uid": event["card_uid"],
+                                  "start_time": datetime.datetime.fromtimestamp(event["start_ts"]).replace(microsecond=0), "end_time": None}
+        elif applied == "close" and current is not None and current.get("id") == event["id"]:
+            open_sessions.pop(did, None)
+
+def on_devices_changed(event: dict):
+    if event.get("device_id") and "maint" in event: device_maint[event["device_id"]] = int(event["maint"])
+
+def on_binding_codes_changed(event: dict):
+    # 带 card_uid 的是其他实例新发放的码，只带 code 的是 web 端已使用的码
+    if event.get("card_uid"): codes.load([event])
+    elif event.get("code"): codes.discard(str(event["code"]))
+
+bus.register("users", on_users_changed)
+bus.register("sessions", on_sessions_changed)
+bus.register("devices", on_devices_changed)
+bus.register("binding_codes", on_binding_codes_changed)
+bus.register("config", lambda event: config_cache.clear())
+
+KIND_PRIORITY = {
+    "card": ingest.PRIO_CRITICAL, "door_card": ingest.PRIO_CRITICAL,
+    "cmd": ingest.PRIO_CRITICAL, "alert": ingest.PRIO_CRITICAL,
+    "state": ingest.PRIO_STATE,
+}
+
+class TracedCursor(metrics.TimedDictCursor):
+    def execute(self, query, args=None):
+        with tracing.span("db", stmt=metrics.stmt_label(query)):
+            return super().execute(query, args)
 
 def get_db_connection():
-    return pymysql.connect(
-        host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS, database=DB_NAME,
-        charset="utf8mb4", autocommit=True, cursorclass=pymysql.cursors.DictCursor
-    )
-
-def get_current_price() -> float:
+    metrics.DB_CONNECTIONS.inc()
+    with tracing.span("db.connect"):
+        return pymysql.connect(
+            host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS, database=DB_NAME,
+            charset="utf8mb4", autocommit=True, cursorclass=TracedCursor
+        )
+
+def update_seat(device_id: str, **fields):
+    if seats is None: return
+    try: seats.update(device_id, **fields)
+    except Exception as e: logging.error("Seat table write error: %s", e)
+
+def load_seats_from_db():
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT d.*, u.username FROM devices d LEFT JOIN users u ON u.id = d.current_user_id")
+            rows = cur.fetchall()
+    finally: conn.close()
+    for r in rows:
+        device_maint[r["device_id"]] = int(r["is_maintenance"])
+        if not shard.may_own(r["device_id"]): continue
+        last = r["last_update"].timestamp() if r["last_update"] else 0.0
+        update_seat(r["device_id"], seat_name=r["seat_name"], status=r["current_status"], maint=r["is_maintenance"],
+                    pc=r["pc_status"], light=r["light_status"], human=r["human_status"], smoke=r["smoke_percent"],
+                    sec=r["current_sec"], fee=float(r["current_fee"] or 0), last_update=last,
+                    user_id=r["current_user_id"] or 0, user_name=r["username"] or "")
+    logging.info("Seat table loaded: %d devices", len(rows))
+
+def pause(secs: float):
+    with tracing.span("sleep", secs=secs): time.sleep(secs)
+
+_last_price = 1.0   # 数据库不可用时沿用最后一次读到的价格
+
+def _load_price() -> float:
+    global _last_price
     conn = get_db_connection()
     price = 1.0
     try:
@@ -51,269 +232,474 @@ def get_current_price() -> float:
             cur.execute("SELECT v FROM config WHERE k='price_per_min'")
             row = cur.fetchone()
             if row: price = float(row['v'])
-    except Exception as e: logging.error(f"Error getting price: {e}")
     finally: conn.close()
+    _last_price = price
     return price
 
-def parse_kv_payload(payload: str) -> Dict[str, str]:
-    result = {}
-    for part in payload.split(";"):
-        if "=" in part:
-            k, v = part.split("=", 1)
-            result[k.strip()] = v.strip()
-    return result
-
-def calc_age_from_id(identity_num: str) -> Optional[int]:
-    if not identity_num or len(identity_num) not in (15, 18): return None
-    try:
-        birth = identity_num[6:14] if len(identity_num) == 18 else "19" + identity_num[6:12]
-        return datetime.date.today().year - int(birth[0:4])
-    except: return None
+@tracing.traced("get_current_price")
+def get_current_price() -> float:
+    try: return config_cache.get("price_per_min", _load_price)
+    except Exception as e:
+        logging.error(f"Error getting price: {e}")
+        # 沿用的价格也放进缓存，MySQL 不可用期间不必每条 state 都等一次连接超时
+        return config_cache.get("price_per_min", lambda: _last_price)
 
-def send_mqtt(device_id: str, subtopic: str, payload_str: str):
-    topic = f"netbar/{device_id}/cmd" if subtopic in ("cmd", "card/resp") else f"netbar/{device_id}/{subtopic}"
-    logging.info("MQTT publish: %s => %s", topic, payload_str)
-    try: payload_bytes = payload_str.encode("gbk", errors="ignore")
-    except: payload_bytes = payload_str.encode("utf-8", errors="ignore")
-    mqtt_client.publish(topic, payload_bytes, qos=0)
+AUTH_COLUMNS = "id, username, card_uid, id_card, balance, total_recharge, is_active"
 
-def log_alarm(device_id: str, alarm_type: str, message: str):
+def load_auth_index():
     conn = get_db_connection()
     try:
+        auth.begin_rebuild()
         with conn.cursor() as cur:
-            cur.execute("INSERT INTO alarm_log (device_id, alarm_type, message, created_at) VALUES (%s, %s, %s, NOW())", (device_id, alarm_type, message))
+            cur.execute(f"SELECT {AUTH_COLUMNS} FROM users WHERE card_uid IS NOT NULL AND card_uid <> ''")
+            auth.build(cur.fetchall())
     finally: conn.close()
+    logging.info("Auth index loaded: %d cards", len(auth))
 
-def get_active_session(device_id: str) -> Optional[Dict]:
+def refresh_auth_user(user_id=None, card_uid=None):
+    try:
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                if user_id is not None: cur.execute(f"SELECT {AUTH_COLUMNS} FROM users WHERE id=%s", (user_id,))
+                else: cur.execute(f"SELECT {AUTH_COLUMNS} FROM users WHERE card_uid=%s", (card_uid,))
+                row = cur.fetchone()
+        finally: conn.close()
+        if row: auth.upsert(row)
+        elif user_id is not None: auth.remove_user(int(user_id))
+    except Exception as e: logging.error("Auth index refresh error: %s", e)
+
+# 索引未命中时回查一次，防止漏掉某次绑卡通知；只有未绑定卡才会走到这里
+@tracing.traced("lookup_card")
+def lookup_card(card_uid: str) -> Optional[auth_index.AuthEntry]:
+    entry = auth.get(card_uid)
+    if entry is None and card_uid:
+        refresh_auth_user(card_uid=card_uid)
+        entry = auth.get(card_uid)
+    return entry
+
+def load_binding_codes():
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM user_session_log WHERE device_id=%s AND end_time IS NULL ORDER BY id DESC LIMIT 1", (device_id,))
-            return cur.fetchone()
+            cur.execute("SELECT code, card_uid, id_card, UNIX_TIMESTAMP(created_at) AS created_ts FROM binding_codes "
+                        "WHERE created_at >= DATE_SUB(NOW(), INTERVAL 1 DAY) ORDER BY id")
+            codes.load(cur.fetchall())
     finally: conn.close()
+    logging.info("Binding codes loaded: %d", len(codes))
 
-def create_session(device_id: str, card_uid: str, user_name: str, rate: float):
+def purge_binding_codes():
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("INSERT INTO user_session_log (user_name, device_id, card_uid, start_time, end_time, duration_sec, fee) VALUES (%s, %s, %s, NOW(), NULL, 0, 0.00)", (user_name, device_id, card_uid))
+            cur.execute("DELETE FROM binding_codes WHERE created_at < DATE_SUB(NOW(), INTERVAL 1 DAY)")
     finally: conn.close()
 
-def close_session_if_exists(device_id: str, reason: str = "normal"):
-    session = get_active_session(device_id)
-    
-    base_price = get_current_price()
-    send_mqtt(device_id, "cmd", f"set_rate;val={base_price:.2f}")
-
-    if not session: return
-    now = datetime.datetime.now()
-    
-    delta = now - session["start_time"]
-    duration_sec = int(delta.total_seconds())
-    if duration_sec < 0: duration_sec = 0
-    
+@tracing.traced("issue_binding_code")
+def issue_binding_code(card_uid: str, id_card: str) -> str:
+    code = codes.issue(card_uid, id_card)
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE card_uid=%s", (session["card_uid"],))
-            u = cur.fetchone()
-            
-            discount = 1.0
-            fee = 0.0
-            if u:
-                total_rech = float(u['total_recharge'])
-                if total_rech >= 1000: discount = 0.9
-                elif total_rech >= 500: discount = 0.93
-                elif total_rech >= 300: discount = 0.95
-                elif total_rech >= 100: discount = 0.98
-            
-                fee = round(duration_sec / 60.0 * (base_price * discount), 2)
-                
-                # ★★★ 修复安全漏洞：封顶扣费，防止超扣 ★★★
-                current_bal = float(u["balance"])
-                if fee > current_bal:
-                    fee = current_bal # 最多扣光现有余额
-            
-            cur.execute("UPDATE user_session_log SET end_time=%s, duration_sec=%s, fee=%s, end_reason=%s WHERE id=%s", (now, duration_sec, fee, reason, session["id"]))
-            if u and fee > 0:
-                new_bal = max(0.0, current_bal - fee)
-                cur.execute("UPDATE users SET balance=%s WHERE id=%s", (new_bal, u["id"]))
-                cur.execute("INSERT INTO consume_log (user_id, session_id, amount, created_at) VALUES (%s, %s, %s, NOW())", (u["id"], session["id"], fee))
-            cur.execute("UPDATE devices SET current_status=0, current_user_id=NULL, last_update=NOW() WHERE device_id=%s", (device_id,))
+            cur.execute("DELETE FROM binding_codes WHERE card_uid=%s", (card_uid,))
+            cur.execute("INSERT INTO binding_codes (code, card_uid, id_card) VALUES (%s, %s, %s)", (code, card_uid, id_card))
     finally: conn.close()
+    bus.publish("binding_codes", code=code, card_uid=card_uid, id_card=id_card, created_ts=time.time())
+    return code
 
-def save_state_to_db(device_id: str, fields: Dict[str, str], raw_payload: str):
-    s = int(fields.get("s", "0") or 0)
-    iu = int(fields.get("iu", "0") or 0)
-    sm = int(fields.get("sm", "0") or 0)
-    sec = int(fields.get("sec", "0") or 0)
-    al = int(fields.get("al", "0") or 0)
+def load_open_sessions():
+    # 查库期间持有 outbox 的 drain_lock，库里的会话加上还没写库的事件就是完整状态，
+    # 不会漏掉恰好在查库和读 pending() 之间写进库的开台
+    conn = get_db_connection()
+    try:
+        with journal.drain_lock:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM user_session_log WHERE end_time IS NULL ORDER BY id")
+                rows = cur.fetchall()
+            loaded = {r["device_id"]: r for r in rows if shard.may_own(r["device_id"])}
+            _replace_open_sessions(loaded)
+    finally: conn.close()
+    logging.info("Open sessions loaded: %d", len(loaded))
 
+def refresh_session(device_id: str):
+    # 只重载一台设备的会话，用法同 load_open_sessions
     conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT current_sec, current_status FROM devices WHERE device_id=%s", (device_id,))
-            row = cur.fetchone()
-            prev_sec = int(row["current_sec"]) if row else 0
-            prev_status = int(row["current_status"]) if row else 0
-            
-            status = 0
-            if iu == 1: status = 1     
-            if sm >= SMOKE_ALARM_TH: status = 2  
-            if al == 1: status = 2      
-
-            cur.execute("""INSERT INTO devices (device_id, seat_name, current_status, pc_status, light_status, human_status, smoke_percent, current_sec, current_fee, last_update) 
-                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW()) 
-                           ON DUPLICATE KEY UPDATE current_status=VALUES(current_status), pc_status=VALUES(pc_status), light_status=VALUES(light_status), human_status=VALUES(human_status), smoke_percent=VALUES(smoke_percent), current_sec=VALUES(current_sec), current_fee=VALUES(current_fee), last_update=NOW()""",
-                        (device_id, device_id, status, int(fields.get("pc",0)), int(fields.get("lt",0)), int(fields.get("hm",0)), sm, sec, float(fields.get("fee",0))))
-            
-            if status == 2 and sm >= SMOKE_ALARM_TH and prev_status != 2:
-                cur.execute("INSERT INTO alarm_log (device_id, alarm_type, message, created_at) VALUES (%s, %s, %s, NOW())", 
-                            (device_id, "SMOKE", f"烟雾浓度过高: {sm}%"))
+        with journal.drain_lock:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM user_session_log WHERE device_id=%s AND end_time IS NULL ORDER BY id DESC LIMIT 1", (device_id,))
+                row = cur.fetchone()
+            _replace_open_sessions({device_id: row} if row else {}, only=device_id)
     finally: conn.close()
 
+def _same_session(a: Dict, b: Dict) -> bool:
+    return bool((a.get("eid") and a.get("eid") == b.get("eid")) or (a.get("id") and a.get("id") == b.get("id")))
+
+def _replace_open_sessions(loaded: Dict[str, Dict], only: Optional[str] = None):
+    # only 不为空时只替换这一台设备的会话
+    with _sessions_lock:
+        # 还在 outbox 里没写进库的开台 / 结账
+        for ev in journal.pending():
+            if not shard.may_own(ev["device_id"]) or (only and ev["device_id"] != only): continue
+            if ev["type"] == "session_start": loaded[ev["device_id"]] = _session_from_event(ev)
+            elif ev["type"] == "session_close": loaded.pop(ev["device_id"], None)
+        for did in [d for d in ([only] if only else list(open_sessions)) if d not in loaded]: open_sessions.pop(did, None)
+        for did, session in loaded.items():
+            current = open_sessions.get(did)
+            # 同一个会话保留内存里的对象 (带 eid，写库后回填了 id)
+            if current is None or not _same_session(current, session): open_sessions[did] = session
+
+def parse_kv_payload(payload: str) -> Dict[str, str]:
+    result = {}
+    for part in payload.split(";"):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            result[k.strip()] = v.strip()
+    return result
+
+def send_mqtt(device_id: str, subtopic: str, payload_str: str):
+    topic = f"netbar/{device_id}/cmd" if subtopic in ("cmd", "card/resp") else f"netbar/{device_id}/{subtopic}"
+    logging.debug("MQTT publish: %s => %s", topic, payload_str)
+    try: payload_bytes = payload_str.encode("gbk", errors="ignore")
+    except: payload_bytes = payload_str.encode("utf-8", errors="ignore")
+    mqtt_client.publish(topic, payload_bytes, qos=0)
+    tracing.event("publish", topic=topic, payload=payload_str[:48])
+    M_PUBLISH.inc(subtopic)
+    started = _swipe_started.pop(device_id, None)
+    if started: M_SWIPE.observe(time.perf_counter() - started[1], started[0])
+
+device_writer = state_writer.StateWriter(get_db_connection, DEVICE_FLUSH_SECS)
+device_writer.transient_errors = (pymysql.err.OperationalError, pymysql.err.InterfaceError, OSError)
+
+alarms = alarm_writer.AlarmWriter(get_db_connection, ALARM_WINDOW_SECS, ALARM_FLUSH_SECS, ALARM_MAX_ENTRIES)
+alarms.transient_errors = (pymysql.err.OperationalError, pymysql.err.InterfaceError, OSError)
+
+def log_alarm(device_id: str, alarm_type: str, message: str):
+    alarms.submit(device_id, alarm_type, message)
+
+def get_active_session(device_id: str) -> Optional[Dict]:
+    return open_sessions.get(device_id)
+
+# ========= 计费事件 =========
+# 开台 / 结账只追加到本地 outbox，由 outbox 线程写入 MySQL；内存里的 open_sessions 立即更新
+journal = outbox.Outbox(OUTBOX_PATH, get_db_connection)
+journal.transient_errors = (pymysql.err.OperationalError, pymysql.err.InterfaceError, OSError)
+
+def _session_from_event(ev: dict) -> Dict:
+    return {"id": None, "eid": ev["eid"], "user_name": ev["user_name"], "device_id": ev["device_id"], "card_uid": ev["card_uid"],
+            "start_time": datetime.datetime.fromtimestamp(ev["ts"]).replace(microsecond=0), "end_time": None}
+
+@tracing.traced("create_session")
+def create_session(device_id: str, card_uid: str, user_name: str, user_id: int, rate: float):
+    with _sessions_lock:
+        ev = journal.append("session_start", device_id=device_id, card_uid=card_uid, user_name=user_name, user_id=user_id, rate=rate)
+        open_sessions[device_id] = _session_from_event(ev)
+
+@tracing.traced("close_session_if_exists")
+def close_session_if_exists(device_id: str, reason: str = "normal"):
+    base_price = get_current_price()
+    send_mqtt(device_id, "cmd", f"set_rate;val={base_price:.2f}")
+
+    # 内存里没有会话也照样记一笔，库里如果有漏掉的未结束会话会一并结掉
+    with _sessions_lock:
+        session = open_sessions.pop(device_id, None)
+        journal.append("session_close", device_id=device_id, reason=reason, base_price=base_price)
+    if session: update_seat(device_id, status=0, user_id=0, user_name="", last_update=time.time())
+
+def apply_session_start(cur, ev: dict) -> Dict:
+    start = datetime.datetime.fromtimestamp(ev["ts"]).replace(microsecond=0)
+    cur.execute("INSERT INTO user_session_log (user_name, device_id, card_uid, start_time, end_time, duration_sec, fee) VALUES (%s, %s, %s, %s, NULL, 0, 0.00)",
+                (ev["user_name"], ev["device_id"], ev["card_uid"], start))
+    session_id = cur.lastrowid
+    cur.execute("UPDATE devices SET current_status=1, current_user_id=%s, last_update=NOW() WHERE device_id=%s", (ev["user_id"], ev["device_id"]))
+    return {"session_id": session_id}
+
+def apply_session_close(cur, ev: dict) -> Optional[Dict]:
+    device_id = ev["device_id"]
+    cur.execute("SELECT * FROM user_session_log WHERE device_id=%s AND end_time IS NULL ORDER BY id DESC LIMIT 1 FOR UPDATE", (device_id,))
+    session = cur.fetchone()
+    if not session: return None
+
+    # 按结账发生的时刻计费，而不是写库的时刻
+    end = datetime.datetime.fromtimestamp(ev["ts"]).replace(microsecond=0)
+    duration_sec = int((end - session["start_time"]).total_seconds())
+    if duration_sec < 0: duration_sec = 0
+
+    cur.execute("SELECT * FROM users WHERE card_uid=%s FOR UPDATE", (session["card_uid"],))
+    u = cur.fetchone()
+    fee = 0.0
+    if u:
+        _, discount = auth_index.tier_of(float(u["total_recharge"]))
+        fee = round(duration_sec / 60.0 * (ev["base_price"] * discount), 2)
+        
+        # ★★★ 修复安全漏洞：封顶扣费，防止超扣 ★★★
+        current_bal = float(u["balance"])
+        if fee > current_bal:
+            fee = current_bal # 最多扣光现有余额
+
+    cur.execute("UPDATE user_session_log SET end_time=%s, duration_sec=%s, fee=%s, end_reason=%s WHERE id=%s", (end, duration_sec, fee, ev["reason"], session["id"]))
+    result = {"session_id": session["id"]}
+    if u and fee > 0:
+        new_bal = max(0.0, current_bal - fee)
+        cur.execute("UPDATE users SET balance=%s WHERE id=%s", (new_bal, u["id"]))
+        cur.execute("INSERT INTO consume_log (user_id, session_id, amount, created_at) VALUES (%s, %s, %s, %s)", (u["id"], session["id"], fee, end))
+        result.update(user_id=u["id"], card_uid=session["card_uid"], balance=new_bal)
+    cur.execute("UPDATE devices SET current_status=0, current_user_id=NULL, last_update=NOW() WHERE device_id=%s", (device_id,))
+    return result
+
+def on_billing_applied(ev: dict, result: Optional[Dict]):
+    if result is None: return
+    if ev["type"] == "session_start":
+        session = open_sessions.get(ev["device_id"])
+        if session and session.get("eid") == ev["eid"]: session["id"] = result["session_id"]
+        if CLUSTER_MODE != cluster.MODE_SINGLE:
+            bus.publish("sessions", device_id=ev["device_id"], applied="start", instance=INSTANCE_ID, id=result["session_id"], eid=ev["eid"],
+                        user_name=ev["user_name"], card_uid=ev["card_uid"], start_ts=ev["ts"])
+    elif ev["type"] == "session_close":
+        if "user_id" in result:
+            auth.set_balance(result["user_id"], result["balance"])
+            bus.publish("users", id=result["user_id"], card_uid=result["card_uid"])
+        if CLUSTER_MODE != cluster.MODE_SINGLE:
+            bus.publish("sessions", device_id=ev["device_id"], applied="close", instance=INSTANCE_ID, id=result["session_id"])
+
+journal.appliers["session_start"] = apply_session_start
+journal.appliers["session_close"] = apply_session_close
+journal.on_applied = on_billing_applied
+
+# ========= 本地快照 / 热启动 =========
+# 定期把座位表、维护标记、未结束会话、价格、卡号索引写到本地；重启时先从快照恢复并开始处理消息，
+# 同时在后台线程里按冷启动的方式从 MySQL 全量加载一遍，覆盖快照里过时的部分。
+# 快照之后已经写进库、从 outbox 截掉的开台 / 结账，在校正完成前 (通常不到一秒) 看不到。
+SEAT_COLS    = tuple(f for f in seat_table.FIELDS if f != "_pad")
+SESSION_COLS = ("id", "eid", "device_id", "user_name", "card_uid", "start_ts")
+CARD_COLS    = tuple(c.strip() for c in AUTH_COLUMNS.split(","))
+
+_seat_reader = seat_table.SeatTableReader(SEAT_TABLE_PATH)
+
+def collect_snapshot() -> dict:
+    sessions = [{**s, "start_ts": s["start_time"].timestamp()} for s in list(open_sessions.values())]
+    return {
+        "instance": INSTANCE_ID,
+        "price": _last_price,
+        "maint": dict(device_maint),
+        "seats": snapshot.pack_table(list((_seat_reader.read_all() or {}).values()), SEAT_COLS),
+        "sessions": snapshot.pack_table(sessions, SESSION_COLS),
+        "cards": snapshot.pack_table(auth.export(), CARD_COLS),
+    }
+
+snapshots = snapshot.Snapshotter(SNAPSHOT_PATH, collect_snapshot, SNAPSHOT_SECS)
+
+def restore_snapshot() -> bool:
+    global _last_price
+    snap = snapshot.read(SNAPSHOT_PATH)
+    if snap is None: return False
+    created, data = snap
+    age = time.time() - created
+    if age > SNAPSHOT_MAX_AGE:
+        logging.warning("Snapshot is %.0fs old, loading from MySQL instead", age)
+        return False
+    _last_price = float(data.get("price") or _last_price)
+    config_cache.get("price_per_min", lambda: _last_price)
+    device_maint.update({did: int(v) for did, v in data.get("maint", {}).items()})
+    auth.build(snapshot.unpack_table(data.get("cards")))
+    loaded = {}
+    for r in snapshot.unpack_table(data.get("sessions")):
+        if not shard.may_own(r["device_id"]): continue
+        start = datetime.datetime.fromtimestamp(r.pop("start_ts")).replace(microsecond=0)
+        loaded[r["device_id"]] = {**r, "start_time": start, "end_time": None}
+    _replace_open_sessions(loaded)
+    # /dev/shm 里的座位表只在主机重启后才会丢，已有的记录比快照新就保留
+    current = _seat_reader.read_all() or {}
+    restored = 0
+    for r in snapshot.unpack_table(data.get("seats")):
+        did = r.pop("device_id")
+        if not shard.may_own(did): continue
+        cur = current.get(did)
+        if cur is None or cur["last_update"] < r["last_update"]:
+            update_seat(did, **r)
+            restored += 1
+    logging.info("Snapshot restored (age %.0fs): %d seats, %d open sessions, %d cards", age, restored, len(loaded), len(auth))
+    return True
+
+def arm_presence():
+    # 重启前在线、重启后再也不发消息的设备也要能报离线: 有未结束会话的设备和最近更新过的座位先挂上离线期限。
+    # 共享订阅下不知道哪些设备会分给本实例，只跟踪收到过消息的设备
+    if CLUSTER_MODE == cluster.MODE_SHARED: return
+    now = time.time()
+    rows = _seat_reader.read_all() or {}
+    armed = 0
+    for did in set(rows) | set(open_sessions):
+        last = rows[did]["last_update"] if did in rows else 0.0
+        if not shard.may_own(did) or (did not in open_sessions and now - last > PRESENCE_ARM_SECS): continue
+        presence.arm(did, last)
+        armed += 1
+    logging.info("Presence armed for %d devices", armed)
+
+def load_state_from_db():
+    load_seats_from_db()
+    load_auth_index()
+    load_open_sessions()
+    load_binding_codes()
+
+def reconcile_with_db():
+    # 热启动后在后台校正；冷启动时 MySQL 连不上也走这里，一直重试到加载成功
+    t0 = time.perf_counter()
+    before = {did: s.get("eid") or s.get("id") for did, s in list(open_sessions.items())}
+    while True:
+        try:
+            load_state_from_db()
+            break
+        except Exception as e:
+            logging.error("Reconcile with MySQL failed, retrying in %.0fs: %s", RECONCILE_RETRY_SECS, e)
+            time.sleep(RECONCILE_RETRY_SECS)
+    config_cache.clear()
+    get_current_price()
+    after = {did: s.get("eid") or s.get("id") for did, s in list(open_sessions.items())}
+    changed = sum(1 for did in before.keys() | after.keys() if before.get(did) != after.get(did))
+    try: arm_presence()
+    except Exception as e: logging.error("Presence arm error: %s", e)
+    M_RECONCILE.set(round(time.perf_counter() - t0, 4))
+    logging.info("Reconciled with MySQL in %.2fs, %d open sessions differed from snapshot", time.perf_counter() - t0, changed)
+    try: snapshots.write_now()
+    except Exception as e: logging.error("Snapshot write error: %s", e)
+
+def save_state_to_db(device_id: str, st: state_codec.DeviceState):
+    # 先做内存里的处理 (座位表、趋势检测、余额检查 / 强制结账)，devices 行交给 device_writer 后台写库，
+    # MySQL 慢或不可用时不影响计费，也不拖住 ingest_worker
+    iu, sm, sec, al = st.iu, st.sm, st.sec, st.al
+    status = 0
+    if iu == 1: status = 1
+    if sm >= SMOKE_ALARM_TH: status = 2
+    if al == 1: status = 2
+
+    prev = seats.get(device_id) if seats is not None else None
+    prev_status = prev["status"] if prev else 0
+    if status == 2 and sm >= SMOKE_ALARM_TH and prev_status != 2:
+        log_alarm(device_id, "SMOKE", f"烟雾浓度过高: {sm}%")
+
     session = get_active_session(device_id)
+    update_seat(device_id, status=status, maint=device_maint.get(device_id, 0), pc=st.pc, light=st.lt,
+                human=st.hm, smoke=sm, sec=sec, fee=st.fee, last_update=time.time(),
+                user_name=session["user_name"] if session else "")
+    device_writer.submit(device_id, status, st.pc, st.lt, st.hm, sm, sec, st.fee)
+    if detector is not None: detector.observe(device_id, sm, st.hm, session is not None)
     if session and iu == 1:
-        conn = get_db_connection()
         force_checkout = False
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT balance, total_recharge FROM users WHERE card_uid=%s", (session["card_uid"],))
-                u = cur.fetchone()
-                if u:
-                    current_balance = float(u["balance"])
-                    total_rech = float(u['total_recharge'])
-                    
-                    discount = 1.0
-                    if total_rech >= 1000: discount = 0.9
-                    elif total_rech >= 500: discount = 0.93
-                    elif total_rech >= 300: discount = 0.95
-                    elif total_rech >= 100: discount = 0.98
-                    
-                    base_price = get_current_price()
-                    actual_price = round(base_price * discount, 2)
-                    
-                    current_fee = (sec / 60.0) * actual_price
-                    
-                    if current_fee >= current_balance:
-                        force_checkout = True
-        finally: conn.close()
+        entry = auth.get(session["card_uid"])
+        if entry:
+            base_price = get_current_price()
+            actual_price = round(base_price * entry.discount, 2)
+            
+            current_fee = (sec / 60.0) * actual_price
+            
+            if current_fee >= entry.balance:
+                force_checkout = True
 
         if force_checkout:
-            send_mqtt(device_id, "cmd", "checkout")
-            time.sleep(0.5)
-            send_mqtt(device_id, "cmd", "msg:余额耗尽，系统自动结账下机")
-            close_session_if_exists(device_id, reason="balance_empty")
+            M_BALANCE_EMPTY.inc()
+            with tracing.start_trace(f"netbar/{device_id}/balance_empty", device=device_id):
+                send_mqtt(device_id, "cmd", "checkout")
+                pause(0.5)
+                send_mqtt(device_id, "cmd", "msg:余额耗尽，系统自动结账下机")
+                close_session_if_exists(device_id, reason="balance_empty")
 
 
-# 座位刷卡逻辑
+# 座位刷卡逻辑：维护状态、占用会话、用户鉴权都来自内存，决策路径上不读库
+@tracing.traced("handle_card_swipe")
 def handle_card_swipe(device_id: str, payload: str):
     kv = parse_kv_payload(payload)
     card_uid = (kv.get("uid") or "").strip().upper()
     id_card = (kv.get("id") or "").strip()
     if not card_uid: return
 
-    active = get_active_session(device_id)
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT current_status, is_maintenance FROM devices WHERE device_id=%s", (device_id,))
-            dev = cur.fetchone()
-            if dev and dev.get("is_maintenance"):
-                send_mqtt(device_id, "cmd", "card_err;code=maint;msg=维护中禁止上机")
-                return
-
-            if active:
-                if active.get("card_uid") == card_uid:
-                    send_mqtt(device_id, "cmd", f"card_ok;uid={card_uid};name={active['user_name']};balance=0;sec=0")
-                    return
-                else:
-                    send_mqtt(device_id, "cmd", "card_err;code=busy;msg=设备繁忙")
-                    return
-
-            cur.execute("SELECT * FROM users WHERE card_uid=%s", (card_uid,))
-            user = cur.fetchone()
-            if not user:
-                cur.execute("DELETE FROM binding_codes WHERE card_uid=%s", (card_uid,))
-                cur.execute("DELETE FROM binding_codes WHERE created_at < DATE_SUB(NOW(), INTERVAL 1 DAY)")
-                
-                code = str(random.randint(100000, 999999))
-                cur.execute("INSERT INTO binding_codes (code, card_uid, id_card) VALUES (%s, %s, %s)", (code, card_uid, id_card))
-                send_mqtt(device_id, "cmd", "card_err;code=unbound;msg=验证失败")
-                time.sleep(0.5)
-                send_mqtt(device_id, "cmd", f"msg:未绑定! 绑定码:{code} 请在网站绑定")
-                return
+    if device_maint.get(device_id):
+        send_mqtt(device_id, "cmd", "card_err;code=maint;msg=维护中禁止上机")
+        return
 
-            if not user["is_active"]:
-                send_mqtt(device_id, "cmd", "card_err;code=disabled;msg=账户禁用")
-                return
-
-            age = calc_age_from_id(user["id_card"]) or 0
-            if age < 18: 
-                send_mqtt(device_id, "cmd", "card_err;code=underage;msg=未成年人禁止")
-            elif float(user["balance"]) < MIN_BALANCE: 
-                send_mqtt(device_id, "cmd", "card_err;code=low_bal;msg=余额不足")
-            else:
-                total_rech = float(user['total_recharge'])
-                discount = 1.0
-                level_name = "普通"
-                if total_rech >= 1000:
-                    discount = 0.9; level_name = "钻石"
-                elif total_rech >= 500:
-                    discount = 0.93; level_name = "黄金"
-                elif total_rech >= 300:
-                    discount = 0.95; level_name = "白银"
-                elif total_rech >= 100:
-                    discount = 0.98; level_name = "青铜"
-
-                base_price = get_current_price()
-                actual_price = round(base_price * discount, 2)
-
-                send_mqtt(device_id, "cmd", f"set_rate;val={actual_price:.2f}")
-                create_session(device_id, card_uid, user["username"], actual_price)
-                cur.execute("UPDATE devices SET current_status=1, current_user_id=%s, last_update=NOW() WHERE device_id=%s", (user["id"], device_id))
-                
-                send_mqtt(device_id, "cmd", f"card_ok;uid={card_uid};name={user['username']};balance={float(user['balance']):.2f};sec=0")
-                time.sleep(0.5)
-                send_mqtt(device_id, "cmd", f"msg:{level_name}会员,专享费率{actual_price:.2f}元/分")
-    finally: conn.close()
-
-def door_open_task(device_id, username, level):
-    send_mqtt(device_id, "cmd", "light_on")
-    send_mqtt(device_id, "cmd", f"msg:门禁已开 {level}会员:{username} 欢迎光临")
+    active = get_active_session(device_id)
+    if active:
+        if active.get("card_uid") == card_uid:
+            send_mqtt(device_id, "cmd", f"card_ok;uid={card_uid};name={active['user_name']};balance=0;sec=0")
+        else:
+            send_mqtt(device_id, "cmd", "card_err;code=busy;msg=设备繁忙")
+        return
+
+    user = lookup_card(card_uid)
+    if not user:
+        code = issue_binding_code(card_uid, id_card)
+        send_mqtt(device_id, "cmd", "card_err;code=unbound;msg=验证失败")
+        pause(0.5)
+        send_mqtt(device_id, "cmd", f"msg:未绑定! 绑定码:{code} 请在网站绑定")
+        return
+
+    if not user.active:
+        send_mqtt(device_id, "cmd", "card_err;code=disabled;msg=账户禁用")
+    elif not user.adult: 
+        send_mqtt(device_id, "cmd", "card_err;code=underage;msg=未成年人禁止")
+    elif user.balance < MIN_BALANCE: 
+        send_mqtt(device_id, "cmd", "card_err;code=low_bal;msg=余额不足")
+    else:
+        base_price = get_current_price()
+        actual_price = round(base_price * user.discount, 2)
+
+        send_mqtt(device_id, "cmd", f"set_rate;val={actual_price:.2f}")
+        create_session(device_id, card_uid, user.username, user.user_id, actual_price)
+        update_seat(device_id, status=1, user_id=user.user_id, user_name=user.username, last_update=time.time())
+        
+        send_mqtt(device_id, "cmd", f"card_ok;uid={card_uid};name={user.username};balance={user.balance:.2f};sec=0")
+        pause(0.5)
+        send_mqtt(device_id, "cmd", f"msg:{user.level_name}会员,专享费率{actual_price:.2f}元/分")
+
+def door_open_task(device_id):
     time.sleep(3)
     send_mqtt(device_id, "cmd", "light_off")
 
 # 门禁刷卡逻辑
+@tracing.traced("handle_door_card")
 def handle_door_card(device_id: str, payload: str):
     kv = parse_kv_payload(payload)
     card_uid = (kv.get("uid") or "").strip().upper()
     id_card = (kv.get("id") or "").strip()
     
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE card_uid=%s", (card_uid,))
-            user = cur.fetchone()
-
-            if not user:
-                cur.execute("DELETE FROM binding_codes WHERE card_uid=%s", (card_uid,))
-                code = str(random.randint(100000, 999999))
-                cur.execute("INSERT INTO binding_codes (code, card_uid, id_card) VALUES (%s, %s, %s)", (code, card_uid, id_card))
-                send_mqtt(device_id, "cmd", f"msg:未绑定! 绑定码:{code} 请在网站绑定")
-            elif not user["is_active"]:
-                send_mqtt(device_id, "cmd", "msg:账户禁用")
-            else:
-                total_rech = float(user['total_recharge'])
-                level_name = "普通"
-                if total_rech >= 1000: level_name = "钻石"
-                elif total_rech >= 500: level_name = "黄金"
-                elif total_rech >= 300: level_name = "白银"
-                elif total_rech >= 100: level_name = "青铜"
-
-                t = threading.Thread(target=door_open_task, args=(device_id, user['username'], level_name))
-                t.start()
-    finally: conn.close()
+    user = lookup_card(card_uid)
+    if not user:
+        code = issue_binding_code(card_uid, id_card)
+        send_mqtt(device_id, "cmd", f"msg:未绑定! 绑定码:{code} 请在网站绑定")
+    elif not user.active:
+        send_mqtt(device_id, "cmd", "msg:账户禁用")
+    else:
+        # 开门提示在处理线程里直接回复，只有延时关灯放到后台线程
+        send_mqtt(device_id, "cmd", "light_on")
+        send_mqtt(device_id, "cmd", f"msg:门禁已开 {user.level_name}会员:{user.username} 欢迎光临")
+        t = threading.Thread(target=door_open_task, args=(device_id,))
+        t.start()
+
+# 上下线事件由时间轮线程投递到入站队列，和该设备的其他消息一起在 worker 里串行处理
+def on_device_online(device_id: str, offline_secs: float):
+    inbox.put(ingest.PRIO_CRITICAL, device_id, (f"netbar/{device_id}/presence", device_id, "online", f"{offline_secs:.0f}", time.perf_counter()))
+
+def on_device_offline(device_id: str, last_seen: float):
+    inbox.put(ingest.PRIO_CRITICAL, device_id, (f"netbar/{device_id}/presence", device_id, "offline", f"{last_seen:.0f}", time.perf_counter()))
+
+presence.on_online = on_device_online
+presence.on_offline = on_device_offline
+
+def handle_device_online(device_id: str, payload: str):
+    offline_secs = float(payload)
+    send_mqtt(device_id, "presence", "online")
+    # 启动后第一次收到的设备不记告警
+    if offline_secs > 0: log_alarm(device_id, "ONLINE", f"设备恢复在线，离线约 {offline_secs:.0f} 秒")
+
+def handle_device_offline(device_id: str, payload: str):
+    if presence.is_online(device_id): return   # 排队期间已经恢复
+    last_seen = datetime.datetime.fromtimestamp(int(payload)).strftime("%H:%M:%S")
+    send_mqtt(device_id, "presence", f"offline;last={payload}")
+    session = get_active_session(device_id)
+    log_alarm(device_id, "OFFLINE", f"设备离线，最后消息时间 {last_seen}" + (f"，使用中: {session['user_name']}" if session else ""))
+    if session and OFFLINE_BILLING_POLICY == "settle":
+        close_session_if_exists(device_id, reason="offline")
+        update_seat(device_id, status=0, user_id=0, user_name="")
+    _adopted.pop(device_id, None)   # 可能已被改派给其他实例，再出现时重新加载
 
 def handle_debug(device_id: str, payload: str):
     pass
@@ -323,37 +709,186 @@ def handle_cmd_from_device(device_id: str, payload: str):
         close_session_if_exists(device_id, reason="user_checkout")
 
 def handle_alert(device_id: str, payload: str):
-    log_alarm(device_id, "ALERT", payload)
+    # 按告警内容分类，同类告警才会合并
+    alarm_type = "OCCUPY" if "occupy" in payload else "NOHUMAN" if "nohuman" in payload else "ALERT"
+    log_alarm(device_id, alarm_type, payload)
     if "occupy" in payload:
         conn = get_db_connection()
         try:
             with conn.cursor() as cur:
                 cur.execute("UPDATE devices SET current_status=2, last_update=NOW() WHERE device_id=%s", (device_id,))
         finally: conn.close()
+        update_seat(device_id, status=2, last_update=time.time())
 
 def on_connect(client, userdata, flags, rc):
     logging.info("MQTT connected rc=%s", rc)
-    if rc == 0: client.subscribe([(TOPIC_STATE, 0), (TOPIC_DEBUG, 0), (TOPIC_CARD, 0), (TOPIC_DOOR, 0), (TOPIC_ALERT, 0), (TOPIC_CMD, 0)])
+    if rc != 0: return
+    device_topics = (TOPIC_STATE, TOPIC_DEBUG, TOPIC_CARD, TOPIC_DOOR, TOPIC_ALERT, TOPIC_CMD)
+    shard.on_connect(client)   # 先订阅成员主题，成员同步之前不认领设备
+    client.subscribe([(shard.topic_filter(t), 0) for t in device_topics] + [(TOPIC_ADMIN_PROFILE, 0), (cache.TOPIC_INVALIDATE, 1)])
+    presence.resume()
+
+def on_disconnect(client, userdata, rc):
+    logging.warning("MQTT disconnected rc=%s", rc)
+    presence.suspend()
+
+# 设备归属变化后，丢掉不再归本实例处理的设备的内存状态，新归属的设备一律从 MySQL 读起
+def on_rebalance(members: tuple):
+    for did in [d for d in list(_swipe_started) if not shard.owns(d)]: _swipe_started.pop(did, None)
+    if seats is not None: seats.drop_local_copies()
+    for did in [d for d in presence.devices() if not shard.owns(d)]:
+        presence.forget(did)
+        if detector is not None: detector.forget(did)
+    for did in [d for d in seqs.devices() if not shard.owns(d)]: seqs.forget(did)
+    with _sessions_lock:
+        for did in [d for d in open_sessions if not shard.owns(d)]: open_sessions.pop(did, None)
+    readopt_all()
+
+def handle_admin_profile(payload: str):
+    try: secs = float(payload.strip() or PROFILE_SECS)
+    except ValueError: secs = PROFILE_SECS
+    if not sampler.start(secs): logging.warning("Profiler already running, ignored")
+
+def on_sigusr1(signum, frame):
+    sampler.start(PROFILE_SECS)
+
+# 多实例时设备可能从其他实例转过来: 共享订阅下 broker 改派时没有任何通知，hash 模式下由 on_rebalance 标记。
+# 设备第一次在本实例出现、重新分片之后、或在本实例离线后再出现时，先从库里重载它的会话再处理消息；
+# 查库失败就在下一条消息时重试。_adopted 记每台设备最近一次加载时的代数，on_rebalance 把代数加一让所有设备重新加载
+_adopted: Dict[str, int] = {}
+_adopt_gen = 0
+
+def readopt_all():
+    global _adopt_gen
+    _adopt_gen += 1
+
+def adopt_device(device_id: str):
+    gen = _adopt_gen
+    try: refresh_session(device_id)
+    except Exception as e:
+        logging.error("Session refresh for %s failed, will retry on next message: %s", device_id, e)
+        return
+    _adopted[device_id] = gen
+
+def dispatch_message(topic: str, did: str, kind: str, payload: str, t_recv: float):
+    if CLUSTER_MODE != cluster.MODE_SINGLE and _adopted.get(did) != _adopt_gen: adopt_device(did)
+    if kind in TRACED_KINDS:
+        queue_ms = round((time.perf_counter() - t_recv) * 1000, 2)
+        # 刷卡耗时从收到消息算到处理过程中第一次回复该设备；处理完仍没回复的 (如空卡号) 不计
+        if kind in ("card", "door_card"): _swipe_started[did] = (kind, t_recv)
+        try:
+            with tracing.start_trace(topic, device=did, queue_ms=queue_ms), M_HANDLER.time(kind):
+                if kind == "card": handle_card_swipe(did, payload)
+                elif kind == "door_card": handle_door_card(did, payload)
+                elif kind == "cmd": handle_cmd_from_device(did, payload)
+        finally: _swipe_started.pop(did, None)
+    else:
+        with M_HANDLER.time(kind):
+            if kind == "state": save_state_to_db(did, payload)
+            elif kind == "debug": handle_debug(did, payload)
+            elif kind == "alert": handle_alert(did, payload)
+            elif kind == "online": handle_device_online(did, payload)
+            elif kind == "offline": handle_device_offline(did, payload)
 
+def ingest_worker():
+    while True:
+        topic, did, kind, payload, t_recv = inbox.get()
+        inbox.update_depth_metrics()
+        try:
+            if not sampler.active:
+                dispatch_message(topic, did, kind, payload, t_recv)
+                continue
+            cpu0 = time.thread_time()
+            try: dispatch_message(topic, did, kind, payload, t_recv)
+            finally: sampler.record_handler(kind, time.thread_time() - cpu0)
+        except Exception as e: logging.exception("Handle error (trace=%s): %s", tracing.current_id(), e)
+
+# paho 回调线程只做解析和入队，处理交给 ingest_worker
 def on_message(client, userdata, msg):
     try:
         topic = msg.topic
-        payload = msg.payload.decode("utf-8", errors="ignore")
+        if shard.handle_message(topic, msg.payload): return
+        if bus.handle_message(topic, msg.payload): return
+        if topic == TOPIC_ADMIN_PROFILE:
+            handle_admin_profile(msg.payload.decode("utf-8", errors="ignore"))
+            return
         parts = topic.split("/")
         if len(parts) == 3 and parts[0] == "netbar":
             did, kind = parts[1], parts[2]
-            if kind == "state": save_state_to_db(did, parse_kv_payload(payload), payload)
-            elif kind == "debug": handle_debug(did, payload)
-            elif kind == "card": handle_card_swipe(did, payload)
-            elif kind == "door_card": handle_door_card(did, payload)
-            elif kind == "alert": handle_alert(did, payload)
-            elif kind == "cmd": handle_cmd_from_device(did, payload)
-    except Exception as e: logging.exception("Handle error: %s", e)
+            if not shard.owns(did):
+                shard.count_foreign()
+                return
+            M_MESSAGES.inc(kind)
+            if kind != "cmd": presence.touch(did)   # cmd 主题也包含本进程下发的命令，不能算设备心跳
+            if kind == "state":
+                # 在入队前解码并按序号丢掉重复 / 乱序的 state，免得旧状态在队列里覆盖新状态
+                payload = state_codec.decode(msg.payload)
+                if not seqs.accept(did, payload.seq, payload.epoch): return
+            else: payload = msg.payload.decode("utf-8", errors="ignore")
+            t_recv = time.perf_counter()
+            inbox.put(KIND_PRIORITY.get(kind, ingest.PRIO_NORMAL), did, (topic, did, kind, payload, t_recv))
+    except Exception as e: logging.exception("Enqueue error: %s", e)
 
 def main():
+    global seats, detector
+    t_start = time.perf_counter()
+    if CLUSTER_MODE != cluster.MODE_SINGLE and not os.environ.get("NETBAR_INSTANCE_ID"):
+        raise SystemExit("cluster mode requires a stable NETBAR_INSTANCE_ID (it keys the outbox and snapshot files)")
+    tracing.configure(TRACE_FILE, SLOW_TRACE_MS / 1000.0)
+    try: seats = seat_table.SeatTableWriter(SEAT_TABLE_PATH, SEAT_TABLE_CAPACITY)
+    except Exception as e: logging.error("Seat table init error: %s", e)
+    journal.recover()
+    try: warm = restore_snapshot()
+    except Exception as e:
+        logging.error("Snapshot restore error, loading from MySQL: %s", e)
+        warm = False
+    if warm: threading.Thread(target=reconcile_with_db, name="reconcile", daemon=True).start()
+    else:
+        try: load_state_from_db()
+        except Exception as e:
+            logging.error("Initial load from MySQL failed, retrying in background: %s", e)
+            threading.Thread(target=reconcile_with_db, name="reconcile", daemon=True).start()
+    presence.suspend()   # 连上 broker (on_connect 里 resume) 之前不判定离线
+    try: arm_presence()
+    except Exception as e: logging.error("Presence arm error: %s", e)
+    ready = time.perf_counter() - t_start
+    M_READY.set(round(ready, 4), "snapshot" if warm else "db")
+    logging.info("State ready in %.3fs (%s)", ready, "snapshot" if warm else "MySQL")
+    snapshots.start()
+    codes.start_sweeper(BINDING_SWEEP_SECS, purge_binding_codes)
+    if hasattr(signal, "SIGUSR1"): signal.signal(signal.SIGUSR1, on_sigusr1)
+    if METRICS_PORT:
+        try:
+            metrics.start_http_server(METRICS_PORT)
+            logging.info("Metrics on http://127.0.0.1:%d/metrics", METRICS_PORT)
+        except OSError as e: logging.error("Metrics port %d unavailable, /metrics disabled: %s", METRICS_PORT, e)
+    threading.Thread(target=ingest_worker, name="ingest-worker", daemon=True).start()
+    presence.start()
+    try:
+        conn = get_db_connection()
+        try: alarm_writer.ensure_schema(conn)
+        finally: conn.close()
+    except Exception as e: logging.error("alarm_log schema check error: %s", e)
+    try:
+        conn = get_db_connection()
+        try: binding_codes.ensure_schema(conn)
+        finally: conn.close()
+    except Exception as e: logging.error("binding_codes schema check error: %s", e)
+    alarms.start()
+    device_writer.start()
+    journal.start()
+    if ANOMALY_ENABLED and anomaly.np is not None:
+        detector = anomaly.AnomalyDetector()
+        detector.start(log_alarm)
+    elif ANOMALY_ENABLED: logging.warning("numpy not installed, anomaly detector disabled")
     if MQTT_USER: mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)
+    shard.configure_client(mqtt_client)
+    shard.rebalance_hooks.append(on_rebalance)
+    shard.start()
+    logging.info("Instance %s, cluster mode %s", INSTANCE_ID, CLUSTER_MODE)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
+    mqtt_client.on_disconnect = on_disconnect
     while True:
         try:
             mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
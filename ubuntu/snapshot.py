@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import Callable, List, Optional, Sequence, Tuple
+import metrics
+
+# ========= 内存状态本地快照 =========
+# server_mqtt 定期把内存状态 (座位表、维护标记、未结束会话、价格、卡号索引) 写成一个本地文件，
+# 重启时先从快照恢复、马上开始处理消息，再在后台用 MySQL 的数据校正。
+#
+# 文件格式: 头部 magic | version u16 | 生成时刻 f64 | crc32 u32，之后是 zlib 压缩的 JSON。
+# 表格类数据按列存 {"cols": [...], "rows": [[...], ...]}，不重复写键名。
+# 写入时先写临时文件并 fsync，再 rename 覆盖，任何时刻磁盘上都是一份完整的快照；
+# 头部或校验不对的文件直接当作没有快照。
+
+MAGIC = b"NBSNAP"
+VERSION = 1
+_HEAD = struct.Struct("<6sHdI")
+
+M_WRITE  = metrics.histogram("netbar_snapshot_write_seconds", "生成并写入快照的耗时")
+M_BYTES  = metrics.gauge("netbar_snapshot_bytes", "最近一次快照的文件大小")
+M_ERRORS = metrics.counter("netbar_snapshot_errors_total", "快照读写失败次数", ("op",))
+
+def pack_table(rows: Sequence[dict], cols: Sequence[str]) -> dict:
+    return {"cols": list(cols), "rows": [[r.get(c) for c in cols] for r in rows]}
+
+def unpack_table(table: Optional[dict]) -> List[dict]:
+    if not table: return []
+    cols = table["cols"]
+    return [dict(zip(cols, row)) for row in table["rows"]]
+
+def write(path: str, data: dict) -> int:
+    body = zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8"), 1)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEAD.pack(MAGIC, VERSION, time.time(), zlib.crc32(body)))
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try: os.fsync(fd)
+        finally: os.close(fd)
+    except OSError: pass   # 部分文件系统不支持对目录 fsync
+    return _HEAD.size + len(body)
+
+def read(path: str) -> Optional[Tuple[float, dict]]:
+    # 返回 (生成时刻, 数据)；文件不存在或损坏时返回 None
+    try:
+        with open(path, "rb") as f: raw = f.read()
+    except FileNotFoundError: return None
+    try:
+        magic, version, created, crc = _HEAD.unpack_from(raw)
+        body = raw[_HEAD.size:]
+        if magic != MAGIC or version != VERSION or zlib.crc32(body) != crc: raise ValueError("bad header or checksum")
+        return created, json.loads(zlib.decompress(body).decode("utf-8"))
+    except (ValueError, struct.error, zlib.error) as e:
+        M_ERRORS.inc("read")
+        logging.error("Snapshot %s unreadable, ignored: %s", path, e)
+        return None
+
+class Snapshotter:
+    def __init__(self, path: str, collect: Callable[[], dict], interval: float = 15.0):
+        self.path = path
+        self.collect = collect
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def write_now(self) -> int:
+        with self._lock, M_WRITE.time():
+            size = write(self.path, self.collect())
+        M_BYTES.set(size)
+        return size
+
+    def start(self):
+        def loop():
+            while True:
+                time.sleep(self.interval)
+                try: self.write_now()
+                except Exception as e:
+                    M_ERRORS.inc("write")
+                    logging.error("Snapshot write error: %s", e)
+        threading.Thread(target=loop, name="snapshot", daemon=True).start()
+
+# ========= 恢复耗时测试 =========
+# python3 snapshot.py [座位数] [卡数]   生成同等规模的快照，测写入和恢复到内存索引的耗时
+
+def _bench(seats: int, cards: int):
+    import datetime
+    import random
+    import tempfile
+    import auth_index
+    import seat_table
+    seat_cols = ("device_id", "seat_name", "status", "maint", "pc", "light", "human", "smoke", "sec", "fee", "last_update", "user_id", "user_name")
+    now = time.time()
+    seat_rows = [{"device_id": f"S{i:05d}", "seat_name": f"{i // 100}区{i % 100:02d}号", "status": random.randint(0, 2), "maint": 0,
+                  "pc": 1, "light": 1, "human": 1, "smoke": random.randint(0, 30), "sec": random.randint(0, 36000),
+                  "fee": round(random.uniform(0, 200), 2), "last_update": now, "user_id": i, "user_name": f"user{i}"} for i in range(seats)]
+    card_rows = [{"id": i, "username": f"user{i}", "card_uid": f"{random.getrandbits(32):08X}", "id_card": "110101199001011234",
+                  "balance": round(random.uniform(0, 500), 2), "total_recharge": random.choice((0, 100, 300, 500, 1000)), "is_active": 1}
+                 for i in range(cards)]
+    session_cols = ("id", "eid", "device_id", "user_name", "card_uid", "start_ts")
+    session_rows = [{"id": i, "eid": None, "device_id": r["device_id"], "user_name": r["user_name"], "card_uid": card_rows[i % cards]["card_uid"],
+                     "start_ts": now - r["sec"]} for i, r in enumerate(seat_rows[::2])]
+    data = {"price": 1.0, "seats": pack_table(seat_rows, seat_cols), "sessions": pack_table(session_rows, session_cols),
+            "cards": pack_table(card_rows, tuple(card_rows[0]))}
+    path = os.path.join(tempfile.mkdtemp(), "bench_snapshot.bin")
+
+    t0 = time.perf_counter()
+    size = write(path, data)
+    t_write = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    _, loaded = read(path)
+    t_read = time.perf_counter() - t0
+    idx = auth_index.AuthIndex()
+    idx.build(unpack_table(loaded["cards"]))
+    sessions = {r["device_id"]: {**r, "start_time": datetime.datetime.fromtimestamp(r["start_ts"]).replace(microsecond=0), "end_time": None}
+                for r in unpack_table(loaded["sessions"])}
+    table = seat_table.SeatTableWriter(path + ".seats", max(seats, 1))
+    for r in unpack_table(loaded["seats"]):
+        table.update(r.pop("device_id"), **r)
+    t_ready = time.perf_counter() - t0
+    assert len(idx) == len({r["card_uid"] for r in card_rows}) and len(sessions) == len(session_rows) and len(seat_table.SeatTableReader(path + ".seats").read_all()) == seats
+    os.remove(path)
+    os.remove(path + ".seats")
+    print(f"seats={seats} cards={cards} sessions={len(session_rows)} snapshot={size / 1024:.0f} KiB")
+    print(f"  write: {t_write * 1e3:.1f} ms   read+decode: {t_read * 1e3:.1f} ms   ready (incl. index + seat table): {t_ready * 1e3:.1f} ms")
+
+if __name__ == "__main__":
+    _bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, int(sys.argv[2]) if len(sys.argv) > 2 else 50000)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import struct
+import sys
+import time
+from typing import Union
+
+# ========= 设备 state 消息编解码 =========
+# 按首字节区分格式，同一台设备可以随时切换：
+#   文本 (现有固件): "s=1;iu=0;pc=1;lt=0;hm=1;sm=12;sec=0;fee=0.00;al=0"，可选追加 ";q=<序号>;ep=<启动次数>"
+#       固件固定顺序的报文走预编译正则的快速路径；顺序不同、缺字段或带未知字段的报文走通用 k=v 解析
+#   二进制: 首字节为版本号 (< 0x20，不会与文本的首字母冲突)，小端定长记录
+#       v1 (16 字节): version u8 | flags u8 | smoke u8 | reserved u8 | seq u32 | sec u32 | fee_cents u32
+#       v2 (20 字节): v1 之后追加 epoch u32
+# flags 位: bit0 s, bit1 iu, bit2 pc, bit3 lt, bit4 hm, bit5 al
+
+BIN_V1 = 1
+BIN_V2 = 2
+_V1 = struct.Struct("<BBBBIII")
+_V2 = struct.Struct("<BBBBIIII")
+
+_FLAG_BITS = (("s", 0), ("iu", 1), ("pc", 2), ("lt", 3), ("hm", 4), ("al", 5))
+
+_FAST = re.compile(r"s=(\d+);iu=(\d+);pc=(\d+);lt=(\d+);hm=(\d+);sm=(\d+);sec=(\d+);fee=(\d+(?:\.\d*)?);al=(\d+)(?:;q=(\d+))?(?:;ep=(\d+))?")
+
+_INT_KEYS = frozenset(("s", "iu", "pc", "lt", "hm", "sm", "sec", "al"))
+
+class DeviceState:
+    __slots__ = ("version", "seq", "s", "iu", "pc", "lt", "hm", "sm", "sec", "fee", "al", "epoch")
+
+    def __init__(self, version: int = 0, seq=None, s: int = 0, iu: int = 0, pc: int = 0, lt: int = 0, hm: int = 0,
+                 sm: int = 0, sec: int = 0, fee: float = 0.0, al: int = 0, epoch=None):
+        self.version = version   # 0 表示文本格式
+        self.seq = seq           # 老固件没有序号 / 启动次数时为 None
+        self.epoch = epoch
+        self.s = s
+        self.iu = iu
+        self.pc = pc
+        self.lt = lt
+        self.hm = hm
+        self.sm = sm
+        self.sec = sec
+        self.fee = fee
+        self.al = al
+
+    def __eq__(self, other):
+        return isinstance(other, DeviceState) and all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return "DeviceState(" + ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__) + ")"
+
+def decode_text(payload: str) -> DeviceState:
+    m = _FAST.fullmatch(payload)
+    if m is not None:
+        s, iu, pc, lt, hm, sm, sec, fee, al, q, ep = m.groups()
+        return DeviceState(0, None if q is None else int(q), int(s), int(iu), int(pc), int(lt), int(hm), int(sm), int(sec), float(fee), int(al),
+                           None if ep is None else int(ep))
+    st = DeviceState()
+    for part in payload.split(";"):
+        k, sep, v = part.partition("=")
+        if not sep: continue
+        k = k.strip()
+        try:
+            if k == "fee": st.fee = float(v)
+            elif k == "q": st.seq = int(v)
+            elif k == "ep": st.epoch = int(v)
+            elif k in _INT_KEYS: setattr(st, k, int(v))
+        except ValueError: pass
+    return st
+
+def decode_binary(payload: bytes) -> DeviceState:
+    version = payload[0]
+    if version == BIN_V1:
+        _, flags, sm, _, seq, sec, fee_cents = _V1.unpack_from(payload)
+        epoch = None
+    elif version == BIN_V2:
+        _, flags, sm, _, seq, sec, fee_cents, epoch = _V2.unpack_from(payload)
+    else: raise ValueError(f"unsupported state version {version}")
+    return DeviceState(version, seq, flags & 1, (flags >> 1) & 1, (flags >> 2) & 1, (flags >> 3) & 1, (flags >> 4) & 1,
+                       sm, sec, fee_cents / 100.0, (flags >> 5) & 1, epoch)
+
+def decode(payload: Union[bytes, str]) -> DeviceState:
+    if isinstance(payload, str): return decode_text(payload)
+    if payload and payload[0] < 0x20: return decode_binary(payload)
+    return decode_text(payload.decode("utf-8", errors="ignore"))
+
+def encode_text(st: DeviceState) -> str:
+    text = f"s={st.s};iu={st.iu};pc={st.pc};lt={st.lt};hm={st.hm};sm={st.sm};sec={st.sec};fee={st.fee:.2f};al={st.al}"
+    if st.seq is not None: text += f";q={st.seq}"
+    if st.epoch is not None: text += f";ep={st.epoch}"
+    return text
+
+def encode_binary(st: DeviceState) -> bytes:
+    flags = 0
+    for name, bit in _FLAG_BITS:
+        if getattr(st, name): flags |= 1 << bit
+    if st.epoch is None: return _V1.pack(BIN_V1, flags, st.sm, 0, st.seq or 0, st.sec, int(round(st.fee * 100)))
+    return _V2.pack(BIN_V2, flags, st.sm, 0, st.seq or 0, st.sec, int(round(st.fee * 100)), st.epoch)
+
+# ========= 解码吞吐量测试 =========
+# python3 state_codec.py [条数]
+
+def _legacy_parse(payload: bytes):
+    # 原先的路径: 解码 + 拆成 dict + 逐个 int()，作为对照
+    fields = {}
+    for part in payload.decode("utf-8", errors="ignore").split(";"):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            fields[k.strip()] = v.strip()
+    return (int(fields.get("s", "0") or 0), int(fields.get("iu", "0") or 0), int(fields.get("sm", "0") or 0),
+            int(fields.get("sec", "0") or 0), int(fields.get("al", "0") or 0), int(fields.get("pc", 0)),
+            int(fields.get("lt", 0)), int(fields.get("hm", 0)), float(fields.get("fee", 0)))
+
+def _bench(n: int):
+    import random
+    states = [DeviceState(0, i, 1, random.randint(0, 1), 1, random.randint(0, 1), random.randint(0, 1),
+                          random.randint(0, 100), random.randint(0, 36000), round(random.uniform(0, 300), 2), 0) for i in range(1000)]
+    text = [encode_text(DeviceState(**{k: getattr(st, k) for k in DeviceState.__slots__ if k not in ("version", "seq", "epoch")})).encode() for st in states]
+    text_seq = [encode_text(st).encode() for st in states]
+    shuffled = [b";".join(reversed(p.split(b";"))) for p in text_seq]
+    binary = [encode_binary(st) for st in states]
+    for st in states: st.epoch = 7
+    text_ep = [encode_text(st).encode() for st in states]
+    binary_ep = [encode_binary(st) for st in states]
+    for b, t, st in zip(binary_ep, text_ep, states):
+        assert decode(b) == DeviceState(BIN_V2, st.seq, st.s, st.iu, st.pc, st.lt, st.hm, st.sm, st.sec, st.fee, st.al, st.epoch)
+        assert decode(t) == DeviceState(0, st.seq, st.s, st.iu, st.pc, st.lt, st.hm, st.sm, st.sec, st.fee, st.al, st.epoch)
+    cases = (("legacy text", _legacy_parse, text), ("text (fast path)", decode, text), ("text + q (fast)", decode, text_seq),
+             ("text + q + ep", decode, text_ep), ("text (generic)", decode, shuffled), ("binary v1", decode, binary),
+             ("binary v2", decode, binary_ep))
+    print(f"{'format':<20} {'bytes':>6} {'msgs/s/core':>12} {'us/msg':>8}")
+    for name, fn, payloads in cases:
+        rounds = max(1, n // len(payloads))
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for p in payloads: fn(p)
+        dt = time.perf_counter() - t0
+        total = rounds * len(payloads)
+        size = sum(len(p) for p in payloads) / len(payloads)
+        print(f"{name:<20} {size:>6.1f} {total / dt:>12,.0f} {dt / total * 1e6:>8.2f}")
+
+if __name__ == "__main__":
+    _bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
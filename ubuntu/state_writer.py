@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+import metrics
+
+# ========= devices 表后台写入 =========
+# state 报文的处理 (座位表、趋势检测、余额检查、强制结账) 全在内存里完成，devices 行的写库交给这里:
+# submit() 只记下每台设备最新的一份状态，后台线程每 FLUSH_SECS 用一条多行 INSERT ... ON DUPLICATE KEY UPDATE 写出。
+# MySQL 变慢或不可用时 ingest_worker 不会被卡住，刷卡也不会排在写库后面。
+# 连接类错误 (transient_errors) 时把这一批放回 (设备期间有更新的以新的为准) 下次重试；
+# 数据本身被拒绝的行记日志后丢弃，不影响其他设备。
+
+UPSERT_SQL = ("INSERT INTO devices (device_id, seat_name, current_status, pc_status, light_status, human_status, smoke_percent, current_sec, current_fee, last_update) "
+              "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
+              "ON DUPLICATE KEY UPDATE current_status=VALUES(current_status), pc_status=VALUES(pc_status), light_status=VALUES(light_status), "
+              "human_status=VALUES(human_status), smoke_percent=VALUES(smoke_percent), current_sec=VALUES(current_sec), "
+              "current_fee=VALUES(current_fee), last_update=VALUES(last_update)")
+
+M_COALESCED = metrics.counter("netbar_device_writes_coalesced_total", "写库前被同设备新状态覆盖的 state 数")
+M_FAILED    = metrics.counter("netbar_device_writes_failed_total", "被数据库拒绝而丢弃的 devices 行数")
+M_FLUSH     = metrics.histogram("netbar_device_flush_seconds", "devices 批量写入耗时")
+M_PENDING   = metrics.gauge("netbar_device_writes_pending", "等待写库的设备数")
+
+class StateWriter:
+    def __init__(self, connect: Callable[[], object], flush_secs: float = 1.0):
+        self.connect = connect
+        self.flush_secs = flush_secs
+        self.transient_errors: tuple = (OSError,)   # 连接类错误，遇到时重试而不是丢弃
+        self._lock = threading.Lock()
+        self._pending: Dict[str, tuple] = {}
+
+    def submit(self, device_id: str, status: int, pc: int, light: int, human: int, smoke: int, sec: int, fee: float):
+        row = (device_id, device_id, status, pc, light, human, smoke, sec, fee, datetime.datetime.now().replace(microsecond=0))
+        with self._lock:
+            if device_id in self._pending: M_COALESCED.inc()
+            self._pending[device_id] = row
+            M_PENDING.set(len(self._pending))
+
+    def _give_back(self, rows: List[Tuple[str, tuple]]):
+        with self._lock:
+            for did, row in rows: self._pending.setdefault(did, row)
+            M_PENDING.set(len(self._pending))
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = list(self._pending.items()), {}
+            M_PENDING.set(0)
+        if not batch: return
+        done = 0
+        with M_FLUSH.time():
+            try:
+                conn = self.connect()
+                try:
+                    # 参数全是占位符时 pymysql 把 executemany 拼成一条多行 INSERT
+                    try:
+                        with conn.cursor() as cur: cur.executemany(UPSERT_SQL, [row for _, row in batch])
+                        return
+                    except self.transient_errors: raise
+                    except Exception as ex: logging.error("Device state batch rejected, retrying row by row: %s", ex)
+                    for did, row in batch:
+                        try:
+                            with conn.cursor() as cur: cur.execute(UPSERT_SQL, row)
+                        except self.transient_errors: raise
+                        except Exception as ex:
+                            logging.error("Device state for %s dropped: %s", did, ex)
+                            M_FAILED.inc()
+                        done += 1
+                finally: conn.close()
+            except Exception as ex:
+                logging.error("Device state write error: %s", ex)
+                self._give_back(batch[done:])
+
+    def start(self):
+        def loop():
+            while True:
+                time.sleep(self.flush_secs)
+                try: self.flush()
+                except Exception as e: logging.error("State writer error: %s", e)
+        threading.Thread(target=loop, name="state-writer", daemon=True).start()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import functools
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import List, Optional
+
+# ========= 轻量链路追踪 =========
+# 每条入站刷卡消息开一个 trace，线程内的 DB 调用 / 下发 / sleep 记录为 span，
+# 总耗时超过阈值的 trace 以 JSON 行追加到本地文件，用本文件的 CLI 查看
+
+SLOW_TRACE_SECS = 0.3
+TRACE_FILE = "slow_traces.jsonl"
+
+_local = threading.local()
+_file_lock = threading.Lock()
+
+def configure(path: Optional[str] = None, slow_secs: Optional[float] = None):
+    global TRACE_FILE, SLOW_TRACE_SECS
+    if path is not None: TRACE_FILE = path
+    if slow_secs is not None: SLOW_TRACE_SECS = slow_secs
+
+class Trace:
+    __slots__ = ("trace_id", "name", "attrs", "wall", "t0", "duration", "spans")
+
+    def __init__(self, name: str, attrs: dict):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.wall = time.time()
+        self.t0 = time.perf_counter()
+        self.duration = 0.0
+        self.spans: List[tuple] = []   # (name, 相对起点秒, 耗时秒, attrs)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id, "name": self.name, "attrs": self.attrs,
+            "ts": round(self.wall, 3), "ms": round(self.duration * 1000, 2),
+            "spans": [{"name": n, "at_ms": round(a * 1000, 2), "ms": round(d * 1000, 2), **at} for n, a, d, at in sorted(self.spans, key=lambda sp: sp[1])],
+        }
+
+def current() -> Optional[Trace]:
+    return getattr(_local, "trace", None)
+
+def current_id() -> str:
+    tr = current()
+    return tr.trace_id if tr else "-"
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    tr = Trace(name, attrs)
+    prev = current()
+    _local.trace = tr
+    try: yield tr
+    finally:
+        _local.trace = prev
+        tr.duration = time.perf_counter() - tr.t0
+        if tr.duration >= SLOW_TRACE_SECS: _write(tr)
+
+@contextmanager
+def span(name: str, **attrs):
+    tr = current()
+    if tr is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try: yield
+    finally: tr.spans.append((name, t0 - tr.t0, time.perf_counter() - t0, attrs))
+
+def traced(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name): return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def event(name: str, **attrs):
+    tr = current()
+    if tr is not None: tr.spans.append((name, time.perf_counter() - tr.t0, 0.0, attrs))
+
+def _write(tr: Trace):
+    try:
+        line = json.dumps(tr.to_dict(), ensure_ascii=False)
+        with _file_lock:
+            with open(TRACE_FILE, "a", encoding="utf-8") as f: f.write(line + "\n")
+    except Exception as e: logging.error("Trace write error: %s", e)
+
+# ========= 命令行查看慢 trace =========
+def _load(path: str) -> List[dict]:
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            try: out.append(json.loads(line))
+            except ValueError: pass
+    return out
+
+def _print_trace(t: dict):
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t["ts"]))
+    print(f"{t['trace_id']}  {stamp}  {t['name']}  {t['ms']:.1f} ms  {t.get('attrs', {})}")
+    for s in t["spans"]:
+        extra = {k: v for k, v in s.items() if k not in ("name", "at_ms", "ms")}
+        print(f"    +{s['at_ms']:8.1f} ms  {s['ms']:8.1f} ms  {s['name']}  {extra if extra else ''}")
+
+def main():
+    ap = argparse.ArgumentParser(description="查看 server_mqtt 写出的慢刷卡 trace")
+    ap.add_argument("file", nargs="?", default=TRACE_FILE)
+    ap.add_argument("--top", type=int, default=10, help="按耗时列出最慢的 N 条")
+    ap.add_argument("--id", help="只显示指定 trace_id 的明细")
+    ap.add_argument("--summary", action="store_true", help="按 span 名汇总耗时")
+    args = ap.parse_args()
+
+    traces = _load(args.file)
+    if args.id:
+        for t in traces:
+            if t["trace_id"].startswith(args.id): _print_trace(t)
+        return
+    if args.summary:
+        agg = defaultdict(lambda: [0, 0.0])
+        for t in traces:
+            for s in t["spans"]:
+                key = s["name"] + (f" {s['stmt']}" if "stmt" in s else "")
+                agg[key][0] += 1
+                agg[key][1] += s["ms"]
+        print(f"{len(traces)} traces")
+        for key, (n, ms) in sorted(agg.items(), key=lambda kv: -kv[1][1]):
+            print(f"{ms:10.1f} ms  {n:6d} x  avg {ms / n:7.1f} ms  {key}")
+        return
+    for t in sorted(traces, key=lambda t: -t["ms"])[:args.top]: _print_trace(t)
+
+if __name__ == "__main__": main()
@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, render_template, redirect, url_for, request, jsonify, flash, session
+from flask import Flask, render_template, redirect, url_for, request, jsonify, flash, session, g, Response, abort
 import pymysql
 import paho.mqtt.client as mqtt
 from datetime import datetime
+import os
 import time
 import threading
 import random  # 新增：用于生成验证码
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+import metrics
+import seat_table
+import cache
+import dbpool
+import pwhash
 
 # ==========================================
 #  配置区域
@@ -29,6 +34,17 @@ DB_NAME = "netbar"
 
 OFFLINE_SECS = 8 
 
+SEAT_TABLE_PATH = "/dev/shm/netbar_seats"   # server_mqtt 写入的共享内存座位表
+
+ADMIN_CACHE_TTL  = 300.0
+USER_CACHE_TTL   = 30.0
+CONFIG_CACHE_TTL = 60.0
+
+DB_POOL_SIZE     = 8     # 每个 worker 保留的空闲连接数
+HASH_WORKERS     = 0     # 每个 worker 的口令哈希线程数，0 表示 CPU 核数的一半
+HASH_MAX_PENDING = 32    # 排队等待哈希的登录请求上限，超出提示稍后再试
+METRICS_DIR      = os.environ.get("NETBAR_METRICS_DIR", "")   # 多 worker 时汇总 /metrics 用的共享目录，serve.py 启动 gunicorn 时自动设置
+
 app = Flask(__name__) 
 app.secret_key = 'super_secret_key_for_netbar_system_lsh0223'
 
@@ -44,28 +60,135 @@ class AdminUser(UserMixin):
         self.username = username
         self.password_hash = password_hash
 
+# ==========================================
+#  缓存 (写操作通过 netbar_internal/invalidate 通知 server_mqtt 和其他 worker 失效)
+# ==========================================
+admin_cache  = cache.TTLCache("admins", 256, ADMIN_CACHE_TTL)
+user_cache   = cache.TTLCache("users_by_id", 4096, USER_CACHE_TTL)
+config_cache = cache.TTLCache("config", 16, CONFIG_CACHE_TTL)
+bus = cache.InvalidationBus()
+
+def on_users_changed(event):
+    if event.get("id") is not None: user_cache.invalidate(int(event["id"]))
+    elif event.get("card_uid"):
+        card = str(event["card_uid"]).strip().upper()
+        user_cache.invalidate_where(lambda k, v: v is not None and (v['card_uid'] or "").upper() == card)
+
+bus.register("users", on_users_changed)
+bus.register("admins", lambda event: admin_cache.invalidate(int(event["id"])))
+bus.register("config", lambda event: config_cache.clear())
+
+def start_bus_listener():
+    client = mqtt.Client(client_id=f"{MQTT_LISTENER_ID}_{os.getpid()}")
+    if MQTT_USER: client.username_pw_set(MQTT_USER, MQTT_PASS)
+    client.on_connect = lambda c, userdata, flags, rc: c.subscribe(cache.TOPIC_INVALIDATE, 1) if rc == 0 else None
+    client.on_message = lambda c, userdata, msg: bus.handle_message(msg.topic, msg.payload)
+    client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
+    client.loop_start()
+    bus.client = client
+
+def get_user_by_id(user_id):
+    def load():
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM users WHERE id=%s", (user_id,))
+                return cur.fetchone()
+        finally: conn.close()
+    return user_cache.get(int(user_id), load)
+
+def get_price_str():
+    def load():
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT v FROM config WHERE k='price_per_min'")
+                row = cur.fetchone()
+                return row['v'] if row else "1.0"
+        finally: conn.close()
+    return config_cache.get("price_per_min", load)
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
-    user = None
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM admins WHERE id=%s", (user_id,))
-            row = cur.fetchone()
-            if row:
-                user = AdminUser(row['id'], row['username'], row['password_hash'])
-    except Exception as e:
-        pass
-    finally:
-        conn.close()
-    return user
+    def load():
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM admins WHERE id=%s", (user_id,))
+                row = cur.fetchone()
+                return AdminUser(row['id'], row['username'], row['password_hash']) if row else None
+        finally: conn.close()
+    # 数据库异常时不缓存，直接按未登录处理
+    try: return admin_cache.get(int(user_id), load)
+    except Exception: return None
 
-def get_db_connection():
+def _connect():
+    metrics.DB_CONNECTIONS.inc()
     return pymysql.connect(
         host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS, database=DB_NAME,
-        charset="utf8mb4", autocommit=True, cursorclass=pymysql.cursors.DictCursor
+        charset="utf8mb4", autocommit=True, cursorclass=metrics.TimedDictCursor
     )
 
+db_pool = dbpool.ConnectionPool(_connect, DB_POOL_SIZE)
+hasher = pwhash.PasswordHasher(HASH_WORKERS, HASH_MAX_PENDING)
+
+def get_db_connection():
+    return db_pool.connection()
+
+@app.errorhandler(pwhash.Busy)
+def _hash_busy(e):
+    flash("当前登录人数较多，请稍后再试", "warning")
+    return redirect(request.url)
+
+# ==========================================
+#  应用工厂 / worker 初始化
+# ==========================================
+# 生产环境由 serve.py 用 gunicorn (多进程 + 线程) 或 waitress 启动，也可以直接 gunicorn "web_app:create_app()"。
+# 连接池、缓存、哈希线程池、MQTT 监听都属于进程私有状态，必须在 fork 之后的 worker 里初始化：
+# 预加载 (preload_app) 时 master 只导入模块，由 post_fork 钩子调用 init_worker()。
+_worker_pid = None
+
+def init_worker():
+    global _worker_pid, hasher, seat_reader
+    if _worker_pid == os.getpid(): return
+    _worker_pid = os.getpid()
+    db_pool.reset()
+    for c in (admin_cache, user_cache, config_cache): c.clear()
+    hasher = pwhash.PasswordHasher(HASH_WORKERS, HASH_MAX_PENDING)
+    seat_reader = seat_table.SeatTableReader(SEAT_TABLE_PATH)
+    start_bus_listener()
+    if METRICS_DIR: metrics.start_dump(METRICS_DIR)
+
+def create_app():
+    init_worker()
+    return app
+
+# ==========================================
+#  运行指标 (/metrics 仅允许本机访问)
+# ==========================================
+M_REQUESTS = metrics.counter("netbar_http_requests_total", "按路由和状态码统计的请求数", ("endpoint", "status"))
+M_REQUEST_SECONDS = metrics.histogram("netbar_http_request_seconds", "按路由统计的请求耗时", ("endpoint",))
+
+@app.before_request
+def _metrics_start():
+    g._t0 = time.perf_counter()
+
+@app.after_request
+def _metrics_finish(resp):
+    t0 = g.pop('_t0', None)
+    if t0 is not None:
+        endpoint = request.endpoint or "unknown"
+        M_REQUEST_SECONDS.observe(time.perf_counter() - t0, endpoint)
+        M_REQUESTS.inc(endpoint, resp.status_code)
+    return resp
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if request.remote_addr not in ("127.0.0.1", "::1"): abort(403)
+    # 多 worker 时汇总所有 worker 的计数，否则只是处理本次请求的那个 worker 的数字
+    body = metrics.render_dir(METRICS_DIR) if METRICS_DIR else metrics.render()
+    return Response(body, content_type=metrics.CONTENT_TYPE)
+
 def send_mqtt_cmd(device_id, action, msg_text=""):
     try:
         client = mqtt.Client(client_id=f"web_cmd_{int(time.time())}_{device_id}")
@@ -118,7 +241,7 @@ def portal_register():
                 if cur.fetchone():
                     flash("用户名已被注册", "danger")
                 else:
-                    pwd_hash = generate_password_hash(password)
+                    pwd_hash = hasher.generate(password)
                     cur.execute("INSERT INTO users (username, password_hash, security_question, security_answer, is_active) VALUES (%s, %s, %s, %s, 1)", 
                                 (username, pwd_hash, question, answer))
                     flash("注册成功，请妥善保管您的密保答案！", "success")
@@ -143,7 +266,7 @@ def portal_login():
             with conn.cursor() as cur:
                 cur.execute("SELECT * FROM users WHERE username=%s", (username,))
                 user = cur.fetchone()
-                if user and user['password_hash'] and check_password_hash(user['password_hash'], password):
+                if user and user['password_hash'] and hasher.check(user['password_hash'], password):
                     if user['is_active'] == 0:
                         flash("账户已被禁用", "danger")
                     else:
@@ -188,7 +311,7 @@ def portal_forgot_password():
                     cur.execute("SELECT security_answer FROM users WHERE username=%s", (username,))
                     user = cur.fetchone()
                     if user and user['security_answer'] == answer:
-                        pwd_hash = generate_password_hash(new_password)
+                        pwd_hash = hasher.generate(new_password)
                         cur.execute("UPDATE users SET password_hash=%s WHERE username=%s", (pwd_hash, username))
                         flash("密码重置成功，请使用新密码登录", "success")
                         return redirect(url_for('portal_login'))
@@ -210,27 +333,22 @@ def portal_logout():
 @app.route("/portal/dashboard")
 def portal_dashboard():
     if 'user_id' not in session: return redirect(url_for('portal_login'))
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE id=%s", (session['user_id'],))
-            user = cur.fetchone()
-            
-            if not user:
-                session.pop('user_id', None)
-                session.pop('username', None)
-                flash("账号登录状态已失效或被删除，请重新登录", "danger")
-                return redirect(url_for('portal_login'))
-
-            total_rech = float(user['total_recharge'])
-            level = "普通会员"
-            discount = 1.0
-            if total_rech >= 1000: level = "钻石会员"; discount = 0.9
-            elif total_rech >= 500: level = "黄金会员"; discount = 0.93
-            elif total_rech >= 300: level = "白银会员"; discount = 0.95
-            elif total_rech >= 100: level = "青铜会员"; discount = 0.98
+    user = get_user_by_id(session['user_id'])
+    
+    if not user:
+        session.pop('user_id', None)
+        session.pop('username', None)
+        flash("账号登录状态已失效或被删除，请重新登录", "danger")
+        return redirect(url_for('portal_login'))
+
+    total_rech = float(user['total_recharge'])
+    level = "普通会员"
+    discount = 1.0
+    if total_rech >= 1000: level = "钻石会员"; discount = 0.9
+    elif total_rech >= 500: level = "黄金会员"; discount = 0.93
+    elif total_rech >= 300: level = "白银会员"; discount = 0.95
+    elif total_rech >= 100: level = "青铜会员"; discount = 0.98
 
-    finally: conn.close()
     return render_template("portal_dashboard.html", user=user, level=level, discount=discount)
 
 @app.route("/portal/bind", methods=["GET", "POST"])
@@ -242,7 +360,7 @@ def portal_bind():
         conn = get_db_connection()
         try:
             with conn.cursor() as cur:
-                cur.execute("SELECT * FROM binding_codes WHERE code=%s AND id_card=%s ORDER BY id DESC LIMIT 1", (code, id_card))
+                cur.execute("SELECT * FROM binding_codes WHERE code=%s AND id_card=%s AND created_at >= DATE_SUB(NOW(), INTERVAL 1 DAY) ORDER BY id DESC LIMIT 1", (code, id_card))
                 record = cur.fetchone()
                 if record:
                     cur.execute("SELECT id FROM users WHERE card_uid=%s", (record['card_uid'],))
@@ -256,6 +374,8 @@ def portal_bind():
                         cur.execute("UPDATE users SET card_uid=%s, id_card=%s, birthdate=%s WHERE id=%s", 
                                     (record['card_uid'], id_card, birthdate, session['user_id']))
                         cur.execute("DELETE FROM binding_codes WHERE code=%s", (code,))
+                        bus.publish("binding_codes", code=code)
+                        bus.publish("users", id=session['user_id'], card_uid=record['card_uid'])
                         flash("卡片及身份信息绑定成功！去网吧刷卡即可直接上机或开门。", "success")
                         return redirect(url_for('portal_dashboard'))
                 else:
@@ -277,6 +397,7 @@ def portal_recharge():
                     new_bal = cur.fetchone()['balance']
                     cur.execute("INSERT INTO recharge_log (user_id, amount, balance_after, remark, created_at) VALUES (%s, %s, %s, '用户自助充值', NOW())", 
                                 (session['user_id'], amount, new_bal))
+                bus.publish("users", id=session['user_id'])
                 flash(f"成功充值 {amount} 元，累计充值可升级会员！", "success")
             finally: conn.close()
     return render_template("portal_recharge.html")
@@ -317,7 +438,7 @@ def login():
             with conn.cursor() as cur:
                 cur.execute("SELECT * FROM admins WHERE username=%s", (username,))
                 admin_data = cur.fetchone()
-            if admin_data and check_password_hash(admin_data['password_hash'], password):
+            if admin_data and hasher.check(admin_data['password_hash'], password or ""):
                 user = AdminUser(admin_data['id'], admin_data['username'], admin_data['password_hash'])
                 login_user(user)
                 with conn.cursor() as cur:
@@ -378,6 +499,7 @@ def users_new():
                 cur.execute("INSERT INTO users (card_uid, username, id_card, birthdate, balance) VALUES (%s, %s, %s, %s, %s)", 
                             (card_uid, username, id_card, birthdate, balance))
         finally: conn.close()
+        bus.publish("users", card_uid=card_uid)
         return redirect(url_for("users_list"))
     return render_template("users_edit.html", user=None, admin_name=current_user.username)
 
@@ -396,6 +518,7 @@ def users_edit(user_id):
             with conn.cursor() as cur:
                 cur.execute("UPDATE users SET username=%s, id_card=%s, birthdate=%s, is_active=%s WHERE id=%s", 
                             (username, id_card, birthdate, is_active, user_id))
+            bus.publish("users", id=user_id)
             return redirect(url_for("users_list"))
         else:
             with conn.cursor() as cur:
@@ -419,6 +542,7 @@ def users_recharge(user_id):
                 cur.execute("UPDATE users SET balance=%s, total_recharge=total_recharge+%s WHERE id=%s", (new_bal, amount, user_id))
                 cur.execute("INSERT INTO recharge_log (user_id, amount, balance_after, remark, created_at) VALUES (%s, %s, %s, '管理员充值', NOW())", 
                             (user_id, amount, new_bal))
+            bus.publish("users", id=user_id)
             return redirect(url_for("users_list"))
         return render_template("users_recharge.html", user=user, admin_name=current_user.username)
     finally:
@@ -431,6 +555,7 @@ def users_delete(user_id):
     try:
         with conn.cursor() as cur: cur.execute("DELETE FROM users WHERE id=%s", (user_id,))
     finally: conn.close()
+    bus.publish("users", id=user_id)
     return redirect(url_for("users_list"))
 
 @app.route("/users/<int:user_id>/detail")
@@ -468,7 +593,7 @@ def logs_alarms():
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM alarm_log ORDER BY created_at DESC LIMIT 200")
+            cur.execute("SELECT * FROM alarm_log ORDER BY COALESCE(last_seen, created_at) DESC LIMIT 200")
             rows = cur.fetchall()
     finally: conn.close()
     return render_template("logs_alarms.html", alarms=rows, admin_name=current_user.username)
@@ -508,14 +633,7 @@ def broadcast():
 @app.route('/get_rate', methods=['GET'])
 @login_required
 def get_rate():
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT v FROM config WHERE k='price_per_min'")
-            row = cur.fetchone()
-            current_price = row['v'] if row else "1.0"
-        return jsonify({"rate": current_price})
-    finally: conn.close()
+    return jsonify({"rate": get_price_str()})
 
 @app.route('/update_rate', methods=['POST'])
 @login_required
@@ -529,6 +647,7 @@ def update_rate():
             cur.execute("INSERT INTO config (k, v) VALUES ('price_per_min', %s) ON DUPLICATE KEY UPDATE v=%s", (new_price, new_price))
             cur.execute("SELECT device_id FROM devices")
             devices = cur.fetchall()
+        bus.publish("config", key="price_per_min")
         cmd_str = f"set_rate;val={float_price:.2f}"
         for dev in devices: send_mqtt_cmd(dev['device_id'], cmd_str)
         return jsonify({"status": "success", "message": "基础费率已更新 (会员刷卡会以此动态打折)"})
@@ -536,9 +655,33 @@ def update_rate():
         return jsonify({"status": "error", "message": str(e)}), 500
     finally: conn.close()
 
+seat_reader = seat_table.SeatTableReader(SEAT_TABLE_PATH)
+
 @app.route("/api/seats_status")
 @login_required
 def api_seats_status():
+    # 优先读共享内存座位表，不访问数据库；server_mqtt 从未启动过时退回查库
+    rows = seat_reader.read_all()
+    if rows is None: return api_seats_status_from_db()
+    now = time.time()
+    data = {}
+    for did, r in rows.items():
+        data[did] = {
+            "status": r['status'],
+            "maint": r['maint'],
+            "user": r['user_name'] or "--",
+            "smoke": r['smoke'],
+            "sec": r['sec'],
+            "fee": r['fee'],
+            "offline": now - r['last_update'] > OFFLINE_SECS,
+            "pc": r['pc'],
+            "light": r['light'],
+            "human": r['human'],
+            "seat_name": r['seat_name']
+        }
+    return jsonify(data)
+
+def api_seats_status_from_db():
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
@@ -584,8 +727,10 @@ def api_cmd():
     try:
         if cmd == "maint_on":
             with conn.cursor() as cur: cur.execute("UPDATE devices SET is_maintenance=1, current_status=0 WHERE device_id=%s", (did,))
+            bus.publish("devices", device_id=did, maint=1)
         elif cmd == "maint_off":
             with conn.cursor() as cur: cur.execute("UPDATE devices SET is_maintenance=0 WHERE device_id=%s", (did,))
+            bus.publish("devices", device_id=did, maint=0)
         if cmd == "checkout":
              with conn.cursor() as cur:
                  cur.execute("SELECT current_user_id FROM devices WHERE device_id=%s", (did,))
@@ -601,9 +746,7 @@ def api_cmd():
                      now = datetime.now()
                      duration_sec = int((now - start_time).total_seconds())
                      
-                     cur.execute("SELECT v FROM config WHERE k='price_per_min'")
-                     row = cur.fetchone()
-                     rate = float(row['v']) if row else 1.0
+                     rate = float(get_price_str())
 
                      fee = 0.0
                      if user_id:
@@ -626,8 +769,10 @@ def api_cmd():
                      if user_id and fee > 0:
                          cur.execute("UPDATE users SET balance = balance - %s WHERE id=%s", (fee, user_id))
                          cur.execute("INSERT INTO consume_log (user_id, session_id, amount, created_at) VALUES (%s, %s, %s, NOW())", (user_id, session_log['id'], fee))
+                         bus.publish("users", id=user_id)
 
                  cur.execute("UPDATE devices SET current_status=0, current_user_id=NULL, current_sec=0, current_fee=0 WHERE device_id=%s", (did,))
+                 bus.publish("sessions", device_id=did)
         
         send_mqtt_cmd(did, cmd, val)
         return jsonify({"status": "ok"})
@@ -697,4 +842,4 @@ def api_report_occupancy():
 if __name__ == "__main__":
     print("🚀 智能无人网吧 用户门户: http://localhost:5000/portal")
     print("🚀 智能无人网吧 管理后台: http://localhost:5000")
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
\ No newline at end of file